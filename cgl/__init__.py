@@ -2,7 +2,7 @@ import cgl
 
 # import some top level class explicitly
 
-from .point import Point
+from .point import Point, PointArray
 from .kdtree import kdtree
 
 __version__ = '0.1.0'
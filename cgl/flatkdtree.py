@@ -0,0 +1,1209 @@
+"""
+Flat (array-backed) point k-D tree
+
+This is the same median-split tree built by kdtree2 in kdtree.py, but
+instead of a linked graph of kDTreeNode objects everything is kept in a
+few contiguous buffers from the array module:
+
+  x, y          coordinates of the points, reordered so that the points
+                under any node occupy one contiguous range
+  index         position of each point in the input
+  start, end    the range of points [start, end) covered by each node
+  left, right   child nodes (-1 if there is no child)
+  axis          split axis of each node
+
+Nodes are numbered in pre-order and the root is node 0. An internal node
+holds the point at position (start+end)//2 and its children cover the
+points before and after that position. A node without children is a
+leaf and all points in its range are checked when it is visited.
+Ranges of up to leaf_size points are not split, so a tree over n points
+has about 2n/leaf_size nodes (n nodes if leaf_size is 1).
+
+All traversals use an explicit stack.
+
+Contact:
+Ningchuan Xiao
+The Ohio State University
+Columbus, OH
+"""
+
+__author__ = "Ningchuan Xiao <ncxiao@gmail.com>"
+
+import mmap
+import sys
+import weakref
+from array import array
+from heapq import heappush, heapreplace
+from math import sqrt
+from multiprocessing import Pool, shared_memory
+from struct import pack, unpack, calcsize
+
+from .point import Point, get_metric
+from .selection import select
+
+INF = float('inf')
+
+# buffers of a flat tree: name, type code, and whether there is one item
+# for each point (True) or for each node (False)
+BUFFERS = [('x', 'd', True), ('y', 'd', True), ('index', 'i', True),
+           ('start', 'i', False), ('end', 'i', False),
+           ('left', 'i', False), ('right', 'i', False),
+           ('axis', 'b', False)]
+
+class kDTreeArrays():
+    """
+    Buffers of a flat point k-D tree.
+
+    The buffers are array objects, or memoryviews of the same type when
+    the tree lives in shared memory.
+    """
+    def __init__(self, n=0, nodes=0):
+        for name, code, per_point in BUFFERS:
+            size = n if per_point else nodes
+            setattr(self, name, array(code, bytes(array(code).itemsize*size)))
+        self.points = None
+        self.ids = None         # keys of the points, in input order
+        self.buffer = None      # memory map the buffers are read from
+        self.bounds = None      # per-node bounding boxes, see summarize
+        self.sums = {}          # per-node attribute sums, see summarize
+        self.columns = {}       # per-point values in input order, see add_column
+        self.workers = None     # WorkerPool used by the batch queries
+    def __len__(self):
+        return len(self.x)
+    def point(self, i):
+        """
+        Returns the point at position i. The original Point object is
+        returned if the tree was built from points. Otherwise a new Point
+        is made whose key is taken from ids, or is the input position of
+        the point if there are no ids.
+        """
+        if self.points is not None:
+            return self.points[self.index[i]]
+        if self.ids is not None:
+            return Point(self.x[i], self.y[i], self.ids[self.index[i]])
+        return Point(self.x[i], self.y[i], self.index[i])
+
+def flat_kdtree(xs, ys, processes=None, leaf_size=1):
+    """
+    Creates a flat point k-D tree using the median point to split the data
+
+    Input
+      xs, ys: sequences of x and y coordinates
+      processes: number of processes used to build the subtrees, or None
+                 to build the tree in this process only
+      leaf_size: the largest number of points in a leaf
+
+    Output
+      A kDTreeArrays object
+    """
+    n = len(xs)
+    if leaf_size < 1:
+        raise Exception('leaf_size must be at least 1')
+    if processes is not None and processes > 1 and n > leaf_size:
+        return parallel_flat_kdtree(xs, ys, processes, leaf_size)
+    f = kDTreeArrays(n, node_count(n, leaf_size))
+    perm = list(range(n))
+    build_nodes(perm, (xs, ys), 0, n, 0, 0, f, leaf_size=leaf_size)
+    f.x = array('d', [xs[i] for i in perm])
+    f.y = array('d', [ys[i] for i in perm])
+    f.index = array('i', perm)
+    return f
+
+def as_doubles(values):
+    """
+    Returns values as an array of doubles. Buffers of doubles, such as
+    arrays and NumPy float64 arrays, are copied as a block of memory.
+    """
+    if isinstance(values, array) and values.typecode == 'd':
+        return values
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return array('d', values)
+    if view.format == 'd' and view.c_contiguous:
+        result = array('d')
+        result.frombytes(view.cast('B'))
+        return result
+    return array('d', view.tolist())
+
+def node_count(n, leaf_size=1, counts=None):
+    """
+    Returns the number of nodes of a flat tree over n points
+    """
+    if n <= leaf_size:
+        return 1 if n > 0 else 0
+    if counts is None:
+        counts = {}
+    if n not in counts:
+        mid = n//2
+        counts[n] = (1 + node_count(mid, leaf_size, counts) +
+                     node_count(n-mid-1, leaf_size, counts))
+    return counts[n]
+
+def build_nodes(perm, coords, lo, hi, depth, node, f, shift=0, cutoff=0,
+                tasks=None, leaf_size=1):
+    """
+    Builds the subtree over the points perm[lo:hi]
+
+    Input
+      perm: list of point indices, rearranged in place
+      coords: (xs, ys) so that xs[i], ys[i] are the coordinates of point i
+      lo, hi: range of perm covered by the subtree
+      depth: depth of the subtree's root
+      node: id of the subtree's root. The subtree takes the ids from node
+            to node+node_count(hi-lo, leaf_size)-1 in pre-order.
+      f: the tree whose node buffers are filled
+      shift: added to lo and hi when they are stored in the tree, used
+             when perm is only a part of the whole permutation
+      cutoff, tasks: if tasks is a list, subtrees with no more than cutoff
+                     points are not built but appended to tasks as
+                     (lo, hi, depth, node)
+      leaf_size: ranges of up to this many points become leaves
+    """
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    counts = {}
+    stack = [(lo, hi, depth, node)] if hi > lo else []
+    while stack:
+        lo, hi, depth, node = stack.pop()
+        if tasks is not None and hi-lo <= cutoff:
+            tasks.append((lo, hi, depth, node))
+            continue
+        axis = depth % 2
+        start[node] = lo+shift
+        end[node] = hi+shift
+        axes[node] = axis
+        left[node] = -1
+        right[node] = -1
+        if hi-lo <= leaf_size:
+            continue
+        mid = (lo+hi)//2
+        select(perm, lo, hi, mid, coords[axis])
+        if mid+1 < hi:
+            right[node] = node+1+node_count(mid-lo, leaf_size, counts)
+            stack.append((mid+1, hi, depth+1, right[node]))
+        if mid > lo:
+            left[node] = node+1
+            stack.append((lo, mid, depth+1, node+1))
+
+def query_kdtree(f, p):
+    """
+    Returns the position of point p in the flat tree f, or -1 if p is not
+    in the tree
+    """
+    if len(f) == 0:
+        return -1
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    px, py = p.x, p.y
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            for j in range(start[i], end[i]):
+                if x[j] == px and y[j] == py:
+                    return j
+            continue
+        mid = (start[i]+end[i])//2
+        if x[mid] == px and y[mid] == py:
+            return mid
+        if axes[i] == 0:
+            v, s = px, x[mid]
+        else:
+            v, s = py, y[mid]
+        # points equal to the split value can be on either side
+        if v >= s and rc >= 0:
+            stack.append(rc)
+        if v <= s and lc >= 0:
+            stack.append(lc)
+    return -1
+
+def depth(f):
+    """
+    Returns the depth of the flat tree
+    """
+    if len(f) == 0:
+        return -1
+    left, right = f.left, f.right
+    result = 0
+    stack = [(0, 0)]
+    while stack:
+        i, d = stack.pop()
+        if d > result:
+            result = d
+        if left[i] >= 0:
+            stack.append((left[i], d+1))
+        if right[i] >= 0:
+            stack.append((right[i], d+1))
+    return result
+
+def range_query_orthogonal(f, rect, found):
+    """
+    Orthogonal (rectangular) range search for points
+
+    Input
+      f: a flat point k-D tree
+      rect: 2D list defining a rectangle as [ [xmin, xmax], [ymin, ymax] ]
+      found: a list to hold points found, declared outside
+
+    Output
+      This function does not return any values. However, all the points
+      found during the query process will be appended to list found.
+    """
+    found.extend([f.point(j) for j in orthogonal_positions(f, rect)])
+
+def orthogonal_positions(f, rect):
+    """
+    Generates the positions of the points of flat tree f that are in
+    rectangle rect, given as [ [xmin, xmax], [ymin, ymax] ]
+    """
+    if len(f) == 0:
+        return
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    (xmin, xmax), (ymin, ymax) = rect
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            for j in range(start[i], end[i]):
+                if xmin <= x[j] <= xmax and ymin <= y[j] <= ymax:
+                    yield j
+            continue
+        mid = (start[i]+end[i])//2
+        px, py = x[mid], y[mid]
+        if xmin <= px <= xmax and ymin <= py <= ymax:
+            yield mid
+        if axes[i] == 0:
+            s, lo, hi = px, xmin, xmax
+        else:
+            s, lo, hi = py, ymin, ymax
+        if rc >= 0 and s <= hi:
+            stack.append(rc)
+        if lc >= 0 and s >= lo:
+            stack.append(lc)
+
+def range_query_circular(f, p, r, found, rmin=0, metric='euclidean'):
+    """
+    Circular range search for points within a radius of r around p
+
+    Input
+      f: a flat point k-D tree
+      p: a Point object around which query is performed
+      r: radius
+      found: a list to hold points found, declared outside
+      rmin: inner radius. Points closer to p than rmin are left out, so
+            the query area is an annulus.
+      metric: name of the distance metric (see point.METRICS) that r and
+              rmin are measured in
+
+    Output
+      This function does not return any values. However, all the points
+      found during the query process will be appended to list found.
+    """
+    found.extend([f.point(j) for j in circular_positions(f, p, r, rmin, metric)])
+
+def circular_positions(f, p, r, rmin=0, metric='euclidean'):
+    """
+    Generates the positions of the points of flat tree f whose distance
+    to point p is between rmin and r
+
+    The cell of each node (the part of the plane its points can be in)
+    is carried along on the stack. A node is skipped when the nearest
+    point of its cell is farther than r from p, or when the farthest
+    point of its cell is closer than rmin.
+    """
+    if len(f) == 0:
+        return
+    if metric != 'euclidean':
+        yield from metric_positions(f, p, r, rmin, metric)
+        return
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    px, py = p.x, p.y
+    r2, rmin2 = r*r, rmin*rmin
+    stack = [(0, -INF, INF, -INF, INF)]     # node and its cell
+    while stack:
+        i, x0, x1, y0, y1 = stack.pop()
+        dx = x0-px if px < x0 else (px-x1 if px > x1 else 0.0)
+        dy = y0-py if py < y0 else (py-y1 if py > y1 else 0.0)
+        if dx*dx + dy*dy > r2:
+            continue
+        if rmin2 > 0:
+            dx, dy = max(px-x0, x1-px), max(py-y0, y1-py)
+            if dx*dx + dy*dy < rmin2:
+                continue
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            for j in range(start[i], end[i]):
+                dx, dy = x[j]-px, y[j]-py
+                if rmin2 <= dx*dx + dy*dy <= r2:
+                    yield j
+            continue
+        mid = (start[i]+end[i])//2
+        dx, dy = x[mid]-px, y[mid]-py
+        if rmin2 <= dx*dx + dy*dy <= r2:
+            yield mid
+        if axes[i] == 0:
+            s = x[mid]
+            if rc >= 0:
+                stack.append((rc, s, x1, y0, y1))
+            if lc >= 0:
+                stack.append((lc, x0, s, y0, y1))
+        else:
+            s = y[mid]
+            if rc >= 0:
+                stack.append((rc, x0, x1, s, y1))
+            if lc >= 0:
+                stack.append((lc, x0, x1, y0, s))
+
+def metric_positions(f, p, r, rmin, metric):
+    """
+    Generates the positions of the points of flat tree f whose distance
+    to point p in the given metric is between rmin and r. A node is
+    skipped when the metric's lower bound of the distance to its cell is
+    larger than r.
+    """
+    distance, rect_distance = get_metric(metric)
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    px, py = p.x, p.y
+    stack = [(0, -INF, INF, -INF, INF)]     # node and its cell
+    while stack:
+        i, x0, x1, y0, y1 = stack.pop()
+        if rect_distance(px, py, x0, x1, y0, y1) > r:
+            continue
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            for j in range(start[i], end[i]):
+                if rmin <= distance(px, py, x[j], y[j]) <= r:
+                    yield j
+            continue
+        mid = (start[i]+end[i])//2
+        if rmin <= distance(px, py, x[mid], y[mid]) <= r:
+            yield mid
+        if axes[i] == 0:
+            s = x[mid]
+            if rc >= 0:
+                stack.append((rc, s, x1, y0, y1))
+            if lc >= 0:
+                stack.append((lc, x0, s, y0, y1))
+        else:
+            s = y[mid]
+            if rc >= 0:
+                stack.append((rc, x0, x1, s, y1))
+            if lc >= 0:
+                stack.append((lc, x0, x1, y0, s))
+
+def knn(f, px, py, n, eps=0, max_visits=None):
+    """
+    Finds the n nearest neighbors of location (px, py) in the flat tree f
+
+    Input
+      eps: approximation factor. Nodes that cannot hold a point closer
+           than the current n-th distance divided by 1+eps are skipped,
+           so every neighbor found is at most 1+eps times farther than
+           the true one.
+      max_visits: stop after checking the points of this many nodes,
+                  or None for no limit. Fewer than n neighbors may be
+                  returned if the limit is reached early.
+
+    Output
+      A list of (squared distance, position) tuples ordered by distance.
+      Ties are ordered by the time the points were found.
+    """
+    if len(f) == 0 or n < 1:
+        return []
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    heap = []           # max-heap of (-squared distance, -seq, position)
+    seq = 0
+    maxd2 = INF
+    shrink = (1+eps)*(1+eps)
+    visits = INF if max_visits is None else max_visits
+    stack = [(0, 0.0)]  # node, squared distance to the node's region
+    while stack and visits > 0:
+        i, bound = stack.pop()
+        if bound*shrink >= maxd2:
+            continue
+        visits -= 1
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            positions = range(start[i], end[i])
+        else:
+            positions = ((start[i]+end[i])//2,)
+        for j in positions:
+            dx, dy = x[j]-px, y[j]-py
+            d2 = dx*dx + dy*dy
+            if len(heap) < n:
+                seq += 1
+                heappush(heap, (-d2, -seq, j))
+                if len(heap) == n:
+                    maxd2 = -heap[0][0]
+            elif d2 < maxd2:
+                seq += 1
+                heapreplace(heap, (-d2, -seq, j))
+                maxd2 = -heap[0][0]
+        if lc < 0 and rc < 0:
+            continue
+        diff = dx if axes[i] == 0 else dy
+        if diff > 0:    # p is on the left of the split
+            nearer, farther = lc, rc
+        else:
+            nearer, farther = rc, lc
+        if farther >= 0:
+            stack.append((farther, max(bound, diff*diff)))
+        if nearer >= 0:
+            stack.append((nearer, bound))
+    return [(-d2, j) for d2, s, j in sorted(heap, reverse=True)]
+
+def metric_knn(f, px, py, n, metric, eps=0, max_visits=None):
+    """
+    Finds the n nearest neighbors of location (px, py) in the flat tree f
+    using any metric in point.METRICS. The cell of each node is kept on
+    the stack and the metric's lower bound of the distance to the cell is
+    used for pruning. See knn for eps and max_visits.
+
+    Output
+      A list of (distance, position) tuples ordered by distance
+    """
+    if len(f) == 0 or n < 1:
+        return []
+    distance, rect_distance = get_metric(metric)
+    x, y = f.x, f.y
+    start, end, left, right, axes = f.start, f.end, f.left, f.right, f.axis
+    heap = []           # max-heap of (-distance, -seq, position)
+    seq = 0
+    maxd = INF
+    visits = INF if max_visits is None else max_visits
+    stack = [(0, 0.0, -INF, INF, -INF, INF)]    # node, bound, cell
+    while stack and visits > 0:
+        i, bound, x0, x1, y0, y1 = stack.pop()
+        if bound*(1+eps) >= maxd:
+            continue
+        visits -= 1
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            positions = range(start[i], end[i])
+        else:
+            positions = ((start[i]+end[i])//2,)
+        for j in positions:
+            d = distance(px, py, x[j], y[j])
+            if len(heap) < n:
+                seq += 1
+                heappush(heap, (-d, -seq, j))
+                if len(heap) == n:
+                    maxd = -heap[0][0]
+            elif d < maxd:
+                seq += 1
+                heapreplace(heap, (-d, -seq, j))
+                maxd = -heap[0][0]
+        if lc < 0 and rc < 0:
+            continue
+        mid = (start[i]+end[i])//2
+        if axes[i] == 0:
+            lcell, rcell = (x0, x[mid], y0, y1), (x[mid], x1, y0, y1)
+        else:
+            lcell, rcell = (x0, x1, y0, y[mid]), (x0, x1, y[mid], y1)
+        children = []
+        if lc >= 0:
+            children.append((rect_distance(px, py, *lcell), lc, lcell))
+        if rc >= 0:
+            children.append((rect_distance(px, py, *rcell), rc, rcell))
+        # the nearer child is checked first
+        children.sort(reverse=True)
+        for bound, c, cell in children:
+            stack.append((c, bound) + cell)
+    return [(-d, j) for d, s, j in sorted(heap, reverse=True)]
+
+def knn_distances(f, px, py, n, eps=0, max_visits=None, metric='euclidean'):
+    """
+    Returns the n nearest neighbors of location (px, py) as a list of
+    (distance, position) in the given metric
+    """
+    if metric == 'euclidean':
+        return [(sqrt(d2), j) for d2, j in knn(f, px, py, n, eps, max_visits)]
+    if metric == 'sqeuclidean':
+        return knn(f, px, py, n, eps, max_visits)
+    return metric_knn(f, px, py, n, metric, eps, max_visits)
+
+def nnquery(f, p, n, found, eps=0, max_visits=None, metric='euclidean'):
+    """
+    Finds the n nearest neighbors of point p in the flat tree f. See knn
+    for eps and max_visits, and point.METRICS for metric.
+
+    Output
+      The neighbors are appended to list found as [point, distance],
+      ordered by distance.
+    """
+    for d, j in knn_distances(f, p.x, p.y, n, eps, max_visits, metric):
+        found.append([f.point(j), d])
+
+def query_batch(f, coords, k, processes=None, eps=0, max_visits=None,
+                metric='euclidean'):
+    """
+    Finds the k nearest neighbors of many locations at once
+
+    Input
+      f: a flat point k-D tree
+      coords: a sequence of (x, y) pairs, or Point objects
+      k: number of neighbors
+      processes: number of processes that share the queries, or None to
+                 answer them in this process only
+      eps, max_visits: approximation factor and limit on the nodes
+                       visited by each query (see knn)
+      metric: name of the distance metric (see point.METRICS)
+
+    Output
+      dist, ind: two lists with one row for each location. Each row
+      has the distances to the k nearest points and the positions of
+      these points in the input of the tree. Rows are padded with INF
+      and -1 if fewer than k points are found.
+    """
+    if processes is not None and processes > 1:
+        rows = parallel_map(f, knn_task,
+                            [(chunk, k, eps, max_visits, metric)
+                             for chunk in chunks(coords, processes)],
+                            processes)
+        return ([r for dist, ind in rows for r in dist],
+                [r for dist, ind in rows for r in ind])
+    index = f.index
+    dist, ind = [], []
+    for c in coords:
+        neighbors = knn_distances(f, c[0], c[1], k, eps, max_visits, metric)
+        pad = k-len(neighbors)
+        dist.append([d for d, j in neighbors] + [INF]*pad)
+        ind.append([index[j] for d, j in neighbors] + [-1]*pad)
+    return dist, ind
+
+def range_query_batch(f, rects, processes=None):
+    """
+    Orthogonal range search for many rectangles at once
+
+    Input
+      f: a flat point k-D tree
+      rects: a sequence of rectangles, each as [ [xmin, xmax], [ymin, ymax] ]
+      processes: number of processes that share the queries, or None to
+                 answer them in this process only
+
+    Output
+      A list with, for each rectangle, the list of the positions in the
+      input of the tree of the points in the rectangle
+    """
+    if processes is not None and processes > 1:
+        rows = parallel_map(f, range_task, chunks(rects, processes), processes)
+        return [r for found in rows for r in found]
+    index = f.index
+    return [[index[j] for j in orthogonal_positions(f, rect)]
+            for rect in rects]
+
+def buffer_layout(n, nodes):
+    """
+    Returns where the buffers of a flat tree with n points and the given
+    number of nodes are when they are packed into one block of memory,
+    as a list of (name, type code, offset, length), and the size of the
+    block in bytes. Each buffer starts at a multiple of 8 bytes.
+    """
+    layout = []
+    offset = 0
+    for name, code, per_point in BUFFERS:
+        length = n if per_point else nodes
+        layout.append((name, code, offset, length))
+        offset += (array(code).itemsize*length + 7) // 8 * 8
+    return layout, offset
+
+def buffer_views(buf, layout):
+    """
+    Returns a kDTreeArrays whose buffers are typed memoryviews of the
+    block buf, positioned according to layout
+    """
+    f = kDTreeArrays()
+    buf = memoryview(buf)
+    for name, code, offset, length in layout:
+        size = array(code).itemsize*length
+        setattr(f, name, buf[offset:offset+size].cast(code))
+    return f
+
+def release_views(f):
+    """
+    Releases the memoryviews of a tree created by buffer_views
+    """
+    for name, code, per_point in BUFFERS:
+        getattr(f, name).release()
+
+def share_tree(f):
+    """
+    Copies the buffers of flat tree f into a new block of shared memory
+
+    Output
+      The SharedMemory object and the layout of the buffers. The caller
+      must close and unlink the shared memory when it is done.
+    """
+    layout, size = buffer_layout(len(f), len(f.start))
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    views = buffer_views(shm.buf, layout)
+    for name, code, per_point in BUFFERS:
+        getattr(views, name)[:] = getattr(f, name)
+    release_views(views)
+    return shm, layout
+
+def attach_tree(name, layout):
+    """
+    Opens a flat tree created by share_tree in another process
+
+    Output
+      The SharedMemory object and a kDTreeArrays backed by it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, buffer_views(shm.buf, layout)
+
+def chunks(items, processes):
+    """
+    Splits a sequence into about four pieces for each process
+    """
+    size = max(-(-len(items) // (4*processes)), 1)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+# the tree attached by each worker process
+worker_tree = None
+
+def init_worker(name, layout):
+    global worker_tree
+    worker_tree = attach_tree(name, layout)
+
+def knn_task(task):
+    coords, k, eps, max_visits, metric = task
+    return query_batch(worker_tree[1], coords, k, None, eps, max_visits,
+                       metric)
+
+def range_task(rects):
+    return range_query_batch(worker_tree[1], rects)
+
+def build_task(task):
+    lo, hi, depth, node, leaf_size = task
+    f = worker_tree[1]
+    perm = f.index[lo:hi].tolist()
+    build_nodes(perm, (f.x, f.y), 0, hi-lo, depth, node, f, shift=lo,
+                leaf_size=leaf_size)
+    f.index[lo:hi] = array('i', perm)
+
+class WorkerPool():
+    """
+    A pool of worker processes that read a flat tree from a block of
+    shared memory. It is kept on the tree (kDTreeArrays.workers), so the
+    tree is copied and the processes are started once rather than for
+    every batch. The pool and the block are released by close, or when
+    the pool is garbage collected.
+    """
+    def __init__(self, shm, layout, processes):
+        pool = Pool(processes, init_worker, (shm.name, layout))
+        self.processes = processes
+        self.pool = pool
+        self.name = shm.name
+        self.finalizer = weakref.finalize(self, release_workers, pool, shm)
+    def map(self, task, items):
+        return self.pool.map(task, items)
+    def close(self):
+        self.finalizer()
+
+def release_workers(pool, shm):
+    pool.terminate()
+    pool.join()
+    shm.close()
+    shm.unlink()
+
+def worker_pool(f, processes):
+    """
+    Returns the WorkerPool of flat tree f, starting it if f has none or if
+    its pool has a different number of processes
+    """
+    if f.workers is not None and f.workers.processes != processes:
+        close_workers(f)
+    if f.workers is None:
+        shm, layout = share_tree(f)
+        try:
+            f.workers = WorkerPool(shm, layout, processes)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+    return f.workers
+
+def close_workers(f):
+    """
+    Stops the worker processes of flat tree f and frees their shared memory
+    """
+    if f.workers is not None:
+        f.workers.close()
+        f.workers = None
+
+def parallel_map(f, task, items, processes):
+    """
+    Runs task on each of items in the pool of worker processes of flat
+    tree f (see worker_pool). Returns the list of results.
+    """
+    return worker_pool(f, processes).map(task, items)
+
+def parallel_flat_kdtree(xs, ys, processes, leaf_size=1):
+    """
+    Creates a flat point k-D tree using a pool of processes
+
+    The top levels of the tree are built in this process until the
+    subtrees are small enough to keep all processes busy. The subtrees
+    are then built by the workers directly into shared memory. The
+    workers and the shared memory are released when the build is done;
+    parallel batch queries start their own (see worker_pool).
+    """
+    n = len(xs)
+    layout, size = buffer_layout(n, node_count(n, leaf_size))
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        shared = buffer_views(shm.buf, layout)
+        # x and y hold the coordinates in input order during the build
+        shared.x[:] = array('d', xs)
+        shared.y[:] = array('d', ys)
+        perm = list(range(n))
+        tasks = []
+        build_nodes(perm, (xs, ys), 0, n, 0, 0, shared,
+                    cutoff=max(n // (4*processes), leaf_size), tasks=tasks,
+                    leaf_size=leaf_size)
+        shared.index[:] = array('i', perm)
+        with Pool(processes, init_worker, (shm.name, layout)) as pool:
+            pool.map(build_task, [task + (leaf_size,) for task in tasks])
+        f = kDTreeArrays()
+        for name, code, per_point in BUFFERS:
+            setattr(f, name, array(code, getattr(shared, name).tobytes()))
+        release_views(shared)
+    finally:
+        shm.close()
+        shm.unlink()
+    f.x = array('d', [xs[i] for i in f.index])
+    f.y = array('d', [ys[i] for i in f.index])
+    return f
+
+def add_column(f, name, values):
+    """
+    Stores values, one for each point of flat tree f in input order, as
+    the column name, such as 'weight'. Columns are summed by summarize
+    and aggregate_range in place of point attributes of the same name.
+    """
+    if len(values) != len(f):
+        raise Exception('A column needs one value for each point')
+    f.columns[name] = as_doubles(values)
+    f.sums.pop(name, None)
+
+def value_getter(f, name):
+    """
+    Returns a function that gives the value of name for the point at
+    position j of flat tree f. The value comes from the column name if
+    f has one, and from the attribute name of the point otherwise.
+    """
+    if name in f.columns:
+        column, index = f.columns[name], f.index
+        return lambda j: column[index[j]]
+    if name == 'x':
+        return f.x.__getitem__
+    if name == 'y':
+        return f.y.__getitem__
+    return lambda j: getattr(f.point(j), name)
+
+def summarize(f, attrs=()):
+    """
+    Computes the bounding box of the points under each node of flat tree
+    f, and the sums of the given columns or point attributes under each
+    node
+
+    Input
+      f: a flat point k-D tree
+      attrs: names of columns (see add_column) or of point attributes,
+             such as 'x'
+
+    Output
+      This function does not return any values. The boxes are stored in
+      f.bounds as four arrays (xmin, xmax, ymin, ymax) and the sums in
+      f.sums, an array for each attribute name.
+    """
+    x, y = f.x, f.y
+    start, end, left, right = f.start, f.end, f.left, f.right
+    nodes = len(start) if len(f) else 0
+    if f.bounds is None:
+        xmin, xmax, ymin, ymax = [array('d', bytes(8*nodes)) for _ in range(4)]
+        # children have larger ids than their parent, so they come first
+        for i in range(nodes-1, -1, -1):
+            lc, rc = left[i], right[i]
+            if lc < 0 and rc < 0:
+                xs, ys = x[start[i]:end[i]], y[start[i]:end[i]]
+                xmin[i], xmax[i] = min(xs), max(xs)
+                ymin[i], ymax[i] = min(ys), max(ys)
+                continue
+            mid = (start[i]+end[i])//2
+            a, b, c, d = x[mid], x[mid], y[mid], y[mid]
+            for k in (lc, rc):
+                if k >= 0:
+                    a, b = min(a, xmin[k]), max(b, xmax[k])
+                    c, d = min(c, ymin[k]), max(d, ymax[k])
+            xmin[i], xmax[i], ymin[i], ymax[i] = a, b, c, d
+        f.bounds = (xmin, xmax, ymin, ymax)
+    for attr in attrs:
+        if attr in f.sums:
+            continue
+        value = value_getter(f, attr)
+        values = [value(j) for j in range(len(f))]
+        sums = array('d', bytes(8*nodes))
+        for i in range(nodes-1, -1, -1):
+            lc, rc = left[i], right[i]
+            if lc < 0 and rc < 0:
+                sums[i] = sum(values[start[i]:end[i]])
+                continue
+            total = values[(start[i]+end[i])//2]
+            if lc >= 0:
+                total += sums[lc]
+            if rc >= 0:
+                total += sums[rc]
+            sums[i] = total
+        f.sums[attr] = sums
+
+def aggregate_range(f, rect, attr=None):
+    """
+    Counts the points of flat tree f in rectangle rect, given as
+    [ [xmin, xmax], [ymin, ymax] ], and sums their column or attribute
+    attr (see summarize)
+
+    Subtrees whose bounding box is inside the rectangle are counted as a
+    whole without visiting their points, so only the O(sqrt(n)) nodes
+    whose box crosses the border of the rectangle are visited.
+
+    Output
+      count, total: total is 0 if attr is None
+    """
+    if len(f) == 0:
+        return 0, 0
+    summarize(f, () if attr is None else (attr,))
+    x, y = f.x, f.y
+    start, end, left, right = f.start, f.end, f.left, f.right
+    xmin, xmax, ymin, ymax = f.bounds
+    sums = f.sums[attr] if attr is not None else None
+    value = value_getter(f, attr) if attr is not None else None
+    (x0, x1), (y0, y1) = rect
+    count, total = 0, 0
+    stack = [0]
+    while stack:
+        i = stack.pop()
+        if xmin[i] > x1 or xmax[i] < x0 or ymin[i] > y1 or ymax[i] < y0:
+            continue
+        if x0 <= xmin[i] and xmax[i] <= x1 and y0 <= ymin[i] and ymax[i] <= y1:
+            count += end[i]-start[i]
+            if sums is not None:
+                total += sums[i]
+            continue
+        lc, rc = left[i], right[i]
+        if lc < 0 and rc < 0:
+            positions = range(start[i], end[i])
+        else:
+            positions = ((start[i]+end[i])//2,)
+            if rc >= 0:
+                stack.append(rc)
+            if lc >= 0:
+                stack.append(lc)
+        for j in positions:
+            if x0 <= x[j] <= x1 and y0 <= y[j] <= y1:
+                count += 1
+                if sums is not None:
+                    total += value(j)
+    return count, total
+
+# node pairs with no more point pairs than this are compared directly,
+# by pairs_within and join_knn
+LEAF_PAIRS = 64
+JOIN_PAIRS = 256
+
+def item_box(f, a):
+    """
+    Returns the range of positions lo, hi and the bounding box x0, x1,
+    y0, y1 of a dual-tree item: node a if a >= 0, or the single point at
+    position -1-a. f.bounds must have been computed by summarize.
+    """
+    if a < 0:
+        j = -1-a
+        return j, j+1, f.x[j], f.x[j], f.y[j], f.y[j]
+    xmin, xmax, ymin, ymax = f.bounds
+    return f.start[a], f.end[a], xmin[a], xmax[a], ymin[a], ymax[a]
+
+def pairs_within(f, r):
+    """
+    Finds all pairs of points of flat tree f within a distance of r
+
+    This is a dual-tree traversal: pairs of subtrees are visited from the
+    root down, and a pair is dropped as soon as the boxes of the two
+    subtrees are farther apart than r. If the boxes are so close that
+    every pair of points is within r, all pairs are taken without
+    computing any distances.
+
+    Output
+      first, second: two arrays of the same length, so that the points
+      at input positions first[i] and second[i] are within r of each
+      other. Each pair is found once, in no particular order.
+    """
+    if r < 0:
+        raise Exception('The distance r must not be negative')
+    first, second = array('i'), array('i')
+    if len(f) < 2:
+        return first, second
+    summarize(f)
+    x, y, index = f.x, f.y, f.index
+    start, end, left, right = f.start, f.end, f.left, f.right
+    r2 = r*r
+    stack = [(0, 0)]    # pairs of items, see item_box
+    while stack:
+        a, b = stack.pop()
+        if a == b:      # pairs inside one subtree
+            lo, hi = start[a], end[a]
+            lc, rc = left[a], right[a]
+            if (lc < 0 and rc < 0) or (hi-lo)*(hi-lo-1) <= 2*LEAF_PAIRS:
+                for j in range(lo, hi):
+                    xj, yj = x[j], y[j]
+                    for k in range(j+1, hi):
+                        dx, dy = x[k]-xj, y[k]-yj
+                        if dx*dx + dy*dy <= r2:
+                            first.append(index[j])
+                            second.append(index[k])
+                continue
+            m = -1-(lo+hi)//2
+            for c in (lc, rc):
+                if c >= 0:
+                    stack.append((c, c))
+                    stack.append((m, c))
+            if lc >= 0 and rc >= 0:
+                stack.append((lc, rc))
+            continue
+        alo, ahi, ax0, ax1, ay0, ay1 = item_box(f, a)
+        blo, bhi, bx0, bx1, by0, by1 = item_box(f, b)
+        dx = max(ax0-bx1, bx0-ax1, 0.0)
+        dy = max(ay0-by1, by0-ay1, 0.0)
+        if dx*dx + dy*dy > r2:
+            continue
+        dx = max(ax1-bx0, bx1-ax0)
+        dy = max(ay1-by0, by1-ay0)
+        if dx*dx + dy*dy <= r2:
+            others = index[blo:bhi]
+            for j in range(alo, ahi):
+                first.extend([index[j]]*(bhi-blo))
+                second.extend(others)
+            continue
+        asplit = a >= 0 and (left[a] >= 0 or right[a] >= 0)
+        bsplit = b >= 0 and (left[b] >= 0 or right[b] >= 0)
+        if (ahi-alo)*(bhi-blo) <= LEAF_PAIRS or not (asplit or bsplit):
+            for j in range(alo, ahi):
+                xj, yj = x[j], y[j]
+                for k in range(blo, bhi):
+                    dx, dy = x[k]-xj, y[k]-yj
+                    if dx*dx + dy*dy <= r2:
+                        first.append(index[j])
+                        second.append(index[k])
+            continue
+        if not bsplit or (asplit and ahi-alo >= bhi-blo):
+            a, b = b, a     # split the larger item, now in b
+        stack.append((a, -1-(start[b]+end[b])//2))
+        for c in (left[b], right[b]):
+            if c >= 0:
+                stack.append((a, c))
+    return first, second
+
+def join_knn(f, g, k, eps=0, metric='euclidean'):
+    """
+    Finds the k nearest points of flat tree g for every point of flat
+    tree f
+
+    Pairs of subtrees, one from each tree, are visited from the roots
+    down with the nearer subtrees of g first. Each node of f keeps the
+    largest distance to a k-th neighbor found so far for any of its
+    points, and a pair is dropped when the boxes of the two subtrees are
+    at least that far apart. With eps > 0 the pair is also dropped when
+    its boxes are at least that distance divided by 1+eps apart, so each
+    neighbor found is at most 1+eps times farther than the true one.
+    The metric can be 'euclidean' or 'sqeuclidean'.
+
+    Output
+      dist, ind: two arrays with k items for each point of f, in the
+      order of the input of f. The items of point i are dist[i*k:i*k+k],
+      the distances to its k nearest points in g, and ind[i*k:i*k+k],
+      the positions of these points in the input of g. They are padded
+      with INF and -1 if g has fewer than k points.
+    """
+    if metric not in ('euclidean', 'sqeuclidean'):
+        raise Exception('join_knn does not support the metric ' + str(metric))
+    n = len(f)
+    dist, ind = array('d', [INF])*(n*k), array('i', [-1])*(n*k)
+    if n == 0 or len(g) == 0 or k < 1:
+        return dist, ind
+    summarize(f)
+    summarize(g)
+    x, y, gx, gy = f.x, f.y, g.x, g.y
+    start, end, left, right = f.start, f.end, f.left, f.right
+    gstart, gend, gleft, gright = g.start, g.end, g.left, g.right
+    # max-heaps of (-d2, -seq, position in g), filled up with dummies
+    heaps = [[(-INF, 0, -1)]*k for j in range(n)]
+    maxd2 = array('d', [INF])*n     # k-th distance of each point of f
+    bound = array('d', [INF])*len(start)  # largest maxd2 under each node
+    seq = 0
+    shrink = (1+eps)*(1+eps)
+    stack = [(0, 0)]    # pairs of items (see item_box), or (node, None)
+    while stack:
+        a, b = stack.pop()
+        if b is None:   # the pairs of the children of a are done
+            lc, rc = left[a], right[a]
+            d2 = maxd2[(start[a]+end[a])//2]
+            if lc >= 0:
+                d2 = max(d2, bound[lc])
+            if rc >= 0:
+                d2 = max(d2, bound[rc])
+            bound[a] = d2
+            continue
+        alo, ahi, ax0, ax1, ay0, ay1 = item_box(f, a)
+        blo, bhi, bx0, bx1, by0, by1 = item_box(g, b)
+        dx = max(ax0-bx1, bx0-ax1, 0.0)
+        dy = max(ay0-by1, by0-ay1, 0.0)
+        if (dx*dx + dy*dy)*shrink >= (maxd2[alo] if a < 0 else bound[a]):
+            continue
+        asplit = a >= 0 and (left[a] >= 0 or right[a] >= 0)
+        bsplit = b >= 0 and (gleft[b] >= 0 or gright[b] >= 0)
+        if (ahi-alo)*(bhi-blo) <= JOIN_PAIRS or not (asplit or bsplit):
+            for j in range(alo, ahi):
+                heap, xj, yj, m = heaps[j], x[j], y[j], maxd2[j]
+                dx = max(bx0-xj, xj-bx1, 0.0)
+                dy = max(by0-yj, yj-by1, 0.0)
+                if (dx*dx + dy*dy)*shrink >= m:
+                    continue
+                for i in range(blo, bhi):
+                    dx, dy = gx[i]-xj, gy[i]-yj
+                    d2 = dx*dx + dy*dy
+                    if d2 < m:
+                        seq += 1
+                        heapreplace(heap, (-d2, -seq, i))
+                        m = -heap[0][0]
+                maxd2[j] = m
+            if a >= 0:
+                bound[a] = max(maxd2[alo:ahi])
+            continue
+        if asplit and (not bsplit or ahi-alo >= bhi-blo):
+            stack.append((a, None))
+            stack.append((-1-(start[a]+end[a])//2, b))
+            for c in (left[a], right[a]):
+                if c >= 0:
+                    stack.append((c, b))
+            continue
+        # visit the children of b nearest to a first
+        cx, cy = (ax0+ax1)/2, (ay0+ay1)/2
+        children = []
+        for c in [-1-(gstart[b]+gend[b])//2] + [c for c in (gleft[b], gright[b]) if c >= 0]:
+            clo, chi, cx0, cx1, cy0, cy1 = item_box(g, c)
+            dx = max(cx0-cx, cx-cx1, 0.0)
+            dy = max(cy0-cy, cy-cy1, 0.0)
+            children.append((dx*dx + dy*dy, c))
+        children.sort(reverse=True)
+        for d2, c in children:
+            stack.append((a, c))
+    index, gindex = f.index, g.index
+    for j in range(n):
+        row = index[j]*k
+        for s, (d2, t, i) in enumerate(sorted(heaps[j], reverse=True)):
+            if i < 0:
+                break
+            dist[row+s] = sqrt(-d2) if metric == 'euclidean' else -d2
+            ind[row+s] = gindex[i]
+    return dist, ind
+
+# file format: a header of HEADER_SIZE bytes followed by the buffers
+# packed as in buffer_layout. The header holds MAGIC, FORMAT_VERSION,
+# the byte order of the buffers (0 little, 1 big), the number of points
+# and the number of nodes.
+MAGIC = b'CGLKDTR\0'
+FORMAT_VERSION = 1
+HEADER = '<8sIB3xQQ'
+HEADER_SIZE = 64
+
+def save_tree(f, path):
+    """
+    Writes flat tree f to a binary file
+    """
+    n, nodes = len(f), len(f.start)
+    layout, size = buffer_layout(n, nodes)
+    byteorder = 0 if sys.byteorder == 'little' else 1
+    header = pack(HEADER, MAGIC, FORMAT_VERSION, byteorder, n, nodes)
+    with open(path, 'wb') as fh:
+        fh.write(header.ljust(HEADER_SIZE, b'\0'))
+        for name, code, offset, length in layout:
+            fh.write(getattr(f, name))
+            fh.write(bytes(-array(code).itemsize*length % 8))
+
+def load_tree(path, use_mmap=True):
+    """
+    Reads a flat tree written by save_tree
+
+    Input
+      path: name of the file
+      use_mmap: True to map the file into memory, so that nothing is
+                read until it is used. Otherwise the buffers are copied
+                into arrays.
+
+    Output
+      A kDTreeArrays object. The original points are not stored in the
+      file and are returned as new Point objects (see kDTreeArrays.point).
+    """
+    with open(path, 'rb') as fh:
+        header = fh.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+            raise Exception('Not a k-D tree file: ' + path)
+        magic, version, byteorder, n, nodes = unpack(HEADER, header[:calcsize(HEADER)])
+        if version != FORMAT_VERSION:
+            raise Exception('Unsupported k-D tree file version ' + str(version))
+        swap = byteorder != (0 if sys.byteorder == 'little' else 1)
+        if swap and use_mmap:
+            raise Exception('Cannot map a k-D tree file of a different byte order')
+        layout, size = buffer_layout(n, nodes)
+        if use_mmap:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(buf) < HEADER_SIZE + size:
+                raise Exception('Truncated k-D tree file: ' + path)
+            f = buffer_views(memoryview(buf)[HEADER_SIZE:], layout)
+            f.buffer = buf
+            return f
+        data = fh.read(size)
+    if len(data) < size:
+        raise Exception('Truncated k-D tree file: ' + path)
+    f = kDTreeArrays()
+    for name, code, offset, length in layout:
+        a = array(code, data[offset:offset+array(code).itemsize*length])
+        if swap:
+            a.byteswap()
+        setattr(f, name, a)
+    return f
+
+class kDTreeNodeView():
+    """
+    A read-only node of a flat tree that looks like a kDTreeNode,
+    so that tree_print in kdtree.py can draw flat trees.
+    """
+    def __init__(self, f, i):
+        self.f = f
+        self.i = i
+    @property
+    def left(self):
+        return node_view(self.f, self.f.left[self.i])
+    @property
+    def right(self):
+        return node_view(self.f, self.f.right[self.i])
+    def __repr__(self):
+        f, i = self.f, self.i
+        if f.left[i] < 0 and f.right[i] < 0 and f.end[i]-f.start[i] > 1:
+            return str([f.point(j) for j in range(f.start[i], f.end[i])])
+        return str(f.point((f.start[i]+f.end[i])//2))
+
+def node_view(f, i=0):
+    """
+    Returns a kDTreeNodeView of node i, or None if there is no such node
+    """
+    if i < 0 or len(f) == 0:
+        return None
+    return kDTreeNodeView(f, i)
@@ -3,6 +3,8 @@ Point k-D tree
 
 The class kdtree is currently just a wrapper around
 some of the functions developed in the GIS Algorithms book.
+With kdtree_type='flat' the tree is stored in contiguous
+arrays instead (see flatkdtree.py).
 
 Contact:
 Ningchuan Xiao
@@ -13,54 +15,389 @@ Columbus, OH
 __author__ = "Ningchuan Xiao <ncxiao@gmail.com>"
 
 INF = float('inf')
+ALPHA = 0.7     # balance factor of scapegoat rebuilding
 
-from .point import Point
+from heapq import heappush, heapreplace
+from itertools import islice
+from math import log
+
+from .point import Point, PointArray, get_metric
+from .selection import select
+from .spatialorder import spatial_order
+from . import flatkdtree
 
 __all__ = ['kdtree']
 
 class kDTreeNode():
     """
-    Node for point k-D trees.
+    Node for point k-D trees. index is the input position of the point.
     """
-    def __init__(self, point, left, right):
+    def __init__(self, point, left, right, index=None):
         self.point = point
         self.left = left
         self.right = right
+        self.index = index
     def __repr__(self):
         return str(self.point)
 
 class kdtree:
-    def __init__(self, points, kdtree_type='balanced'):
-        if kdtree_type != 'balanced':
+    """
+    Point k-D tree
+
+    points can be a list of Point objects or a PointArray.
+    kdtree_type can be 'balanced' (median split, the default),
+    'unbalanced' (points inserted in the given order), or 'flat'
+    (median split stored in arrays, which uses much less memory).
+    A flat tree can be built by a number of worker processes, and its
+    leaves can hold up to leaf_size points each, which are scanned in
+    a simple loop instead of being split further.
+
+    Points can be inserted into and deleted from the linked (balanced
+    and unbalanced) trees. Subtrees that become too deep or too small
+    are rebuilt as in a scapegoat tree, so the depth stays O(log n).
+
+    metric is the distance used by the neighbor and circular range
+    queries: 'euclidean' (the default), 'sqeuclidean', or 'haversine'
+    for points given as longitude (x) and latitude (y) in degrees, with
+    distances in kilometers (see point.METRICS).
+
+    weights gives a value for each point of a flat tree, in input order,
+    whose sums over rectangles are returned by sum_range.
+    """
+    def __init__(self, points, kdtree_type='balanced', processes=None,
+                 leaf_size=1, metric='euclidean', weights=None):
+        get_metric(metric)
+        self.metric = metric
+        self.root = None
+        self.flat = None
+        if kdtree_type == 'flat' and isinstance(points, PointArray):
+            # the columns are used as they are, and the points returned
+            # by queries are made from them
+            self.flat = flatkdtree.flat_kdtree(points.x, points.y,
+                                               processes, leaf_size)
+            self.flat.ids = points.key
+        elif kdtree_type == 'flat':
+            self.flat = flatkdtree.flat_kdtree([p.x for p in points],
+                                               [p.y for p in points],
+                                               processes, leaf_size)
+            self.flat.points = points
+        elif leaf_size != 1:
+            raise Exception('leaf_size needs a flat k-D tree')
+        elif processes is not None:
+            raise Exception('processes needs a flat k-D tree')
+        elif weights is not None:
+            raise Exception('weights needs a flat k-D tree')
+        elif kdtree_type != 'balanced':
             self.root = kdtree1(points)
         else:
             self.root = kdtree2(points)
+        if self.flat is not None:
+            self.size = len(self.flat)
+            if weights is not None:
+                flatkdtree.add_column(self.flat, 'weight', weights)
+        else:
+            self.size = tree_size(self.root)
+        self.max_size = self.size
+        self.next_index = len(points)   # input position of the next insert
+    @classmethod
+    def from_arrays(cls, xs, ys, ids=None, processes=None, leaf_size=1,
+                    metric='euclidean', weights=None):
+        """
+        Creates a flat tree straight from sequences of x and y coordinates,
+        such as arrays or NumPy arrays, without any Point objects. The
+        points returned by queries are made when they are found, and
+        their key is taken from ids, or is the position of the point in
+        xs and ys if ids is None.
+        """
+        get_metric(metric)
+        xs, ys = flatkdtree.as_doubles(xs), flatkdtree.as_doubles(ys)
+        if len(xs) != len(ys) or (ids is not None and len(ids) != len(xs)):
+            raise Exception('xs, ys and ids must have the same length')
+        tree = cls.__new__(cls)
+        tree.metric = metric
+        tree.root = None
+        tree.flat = flatkdtree.flat_kdtree(xs, ys, processes, leaf_size)
+        tree.flat.ids = ids
+        tree.size = tree.max_size = len(tree.flat)
+        if weights is not None:
+            flatkdtree.add_column(tree.flat, 'weight', weights)
+        return tree
+    @classmethod
+    def from_shapex(cls, shp, processes=None, leaf_size=1, metric='euclidean'):
+        """
+        Creates a flat tree from a Point or MultiPoint layer opened with
+        cgl.util.shapex. The coordinates are read straight from the file
+        and the key of each point is the index of its feature.
+        """
+        xs, ys, ids = shp.point_coordinates()
+        return cls.from_arrays(xs, ys, ids, processes, leaf_size, metric)
+    def insert(self, p):
+        """
+        Inserts point p. Returns False if p is already in the tree.
+        """
+        if self.flat is not None:
+            raise Exception('A flat k-D tree cannot be changed')
+        self.root, inserted = insert_kdtree(self.root, p, self.size+1,
+                                            index=self.next_index)
+        if inserted:
+            self.size += 1
+            self.max_size = max(self.max_size, self.size)
+            self.next_index += 1
+        return inserted
+    def delete(self, p):
+        """
+        Deletes point p. Returns False if p is not in the tree.
+        """
+        if self.flat is not None:
+            raise Exception('A flat k-D tree cannot be changed')
+        self.root, deleted = delete_kdtree(self.root, p)
+        if deleted:
+            self.size -= 1
+            if self.size < ALPHA*self.max_size:
+                self.root = kdtree2(*tree_items(self.root))
+                self.max_size = self.size
+        return deleted
     def query_kdtree(self, p, depth=0, is_find_only=True):
+        if self.flat is not None:
+            # a flat tree can only be searched for existing points
+            i = flatkdtree.query_kdtree(self.flat, p)
+            if i < 0:
+                return None, None
+            return self.flat.point(i), None
         return query_kdtree(self.root, p, depth, is_find_only)
+    def save(self, path):
+        """
+        Writes a flat tree to a binary file that can be opened with load
+        """
+        if self.flat is None:
+            raise Exception('save needs a flat k-D tree')
+        flatkdtree.save_tree(self.flat, path)
+    @classmethod
+    def load(cls, path, mmap=True, metric='euclidean'):
+        """
+        Opens a tree written by save. With mmap=True the file is mapped
+        into memory and nothing is read or parsed until it is queried.
+        The points are returned as new Point objects whose key is their
+        position in the input of the saved tree.
+        """
+        get_metric(metric)
+        tree = cls.__new__(cls)
+        tree.metric = metric
+        tree.root = None
+        tree.flat = flatkdtree.load_tree(path, mmap)
+        tree.size = tree.max_size = len(tree.flat)
+        return tree
+    def close(self):
+        """
+        Stops the worker processes that a flat tree keeps for parallel
+        batch queries and frees the shared memory they read. They are
+        started again by the next batch query that asks for processes.
+        """
+        if self.flat is not None:
+            flatkdtree.close_workers(self.flat)
     def depth(self):
+        if self.flat is not None:
+            return flatkdtree.depth(self.flat)
         return depth(self.root)
     def draw(self):
-        tree_print(self.root)
+        if self.flat is not None:
+            tree_print(flatkdtree.node_view(self.flat))
+        else:
+            tree_print(self.root)
     def range_query_orthogonal(self, rect):
         found = []
-        range_query_orthogonal(self.root, rect, found)
+        if self.flat is not None:
+            flatkdtree.range_query_orthogonal(self.flat, rect, found)
+        else:
+            range_query_orthogonal(self.root, rect, found)
         return found
-    def range_query_circular(self, p, r):
+    def range_query_circular(self, p, r, rmin=0):
+        """
+        Returns the points within a radius of r around p. With rmin > 0
+        the points closer to p than rmin are left out (an annulus query).
+        """
         found = []
-        range_query_circular(self.root, p, r, found)
+        if self.flat is not None:
+            flatkdtree.range_query_circular(self.flat, p, r, found, rmin,
+                                            self.metric)
+        else:
+            range_query_circular(self.root, p, r, found, 0, rmin, self.metric)
         return found
-    def nearest_neighbor_query(self, p, n=1):
+    def iter_range_orthogonal(self, rect, limit=None):
+        """
+        Generates the points in rect one at a time, without collecting
+        them in a list first. Stops after limit points if limit is given.
+        """
+        if self.flat is not None:
+            f = self.flat
+            found = (f.point(j) for j in flatkdtree.orthogonal_positions(f, rect))
+        else:
+            found = iter_range_orthogonal(self.root, rect)
+        return islice(found, limit)
+    def iter_range_circular(self, p, r, limit=None, rmin=0):
+        """
+        Generates the points within a radius of r around p (and not
+        closer than rmin) one at a time. Stops after limit points if
+        limit is given.
+        """
+        if self.flat is not None:
+            f = self.flat
+            found = (f.point(j) for j in
+                     flatkdtree.circular_positions(f, p, r, rmin, self.metric))
+        else:
+            found = iter_range_circular(self.root, p, r, 0, rmin, self.metric)
+        return islice(found, limit)
+    def summarize(self, *attrs, **columns):
+        """
+        Stores the bounding box of each node of a flat tree, and the sums
+        of the named columns or point attributes under each node, so that
+        count_range and sum_range do not have to visit every point in the
+        rectangle. Both call this when needed, so it only has to be called
+        to pay the cost up front.
+
+        columns adds per-point values, such as weight=[...], given in the
+        input order of the tree. They are summed by sum_range(rect, name).
+        """
+        if self.flat is None:
+            raise Exception('summarize needs a flat k-D tree')
+        for name, values in columns.items():
+            flatkdtree.add_column(self.flat, name, values)
+        flatkdtree.summarize(self.flat, attrs + tuple(columns))
+    def count_range(self, rect):
+        """
+        Returns the number of points in rect
+        """
+        if self.flat is not None:
+            return flatkdtree.aggregate_range(self.flat, rect)[0]
+        return sum(1 for p in iter_range_orthogonal(self.root, rect))
+    def sum_range(self, rect, attr='weight'):
+        """
+        Returns the sum of column attr of the points in rect (see
+        summarize), or of the point attribute attr, such as 'x', if the
+        tree has no such column. The weights given to the constructor or
+        to from_arrays are the column 'weight'.
+        """
+        if self.flat is not None:
+            return flatkdtree.aggregate_range(self.flat, rect, attr)[1]
+        return sum(getattr(p, attr) for p in iter_range_orthogonal(self.root, rect))
+    def pairs_within(self, r):
+        """
+        Returns all pairs of points within a distance of r of each other
+        as two arrays of input positions (see flatkdtree.pairs_within).
+        Only for flat trees.
+        """
+        if self.flat is None:
+            raise Exception('pairs_within needs a flat k-D tree')
+        if self.metric != 'euclidean':
+            raise Exception('pairs_within only supports the euclidean metric')
+        return flatkdtree.pairs_within(self.flat, r)
+    def join_knn(self, other, k=1, eps=0):
+        """
+        Finds the k nearest points of tree other for each point of this
+        tree. Returns two arrays with k distances and k input positions
+        of other for each point (see flatkdtree.join_knn). eps is as in
+        nearest_neighbor_query. Only for flat trees.
+        """
+        if self.flat is None or other.flat is None:
+            raise Exception('join_knn needs two flat k-D trees')
+        if self.metric != other.metric:
+            raise Exception('join_knn needs two trees with the same metric')
+        return flatkdtree.join_knn(self.flat, other.flat, k, eps, self.metric)
+    def nearest_neighbor_query(self, p, n=1, eps=0, max_visits=None):
+        """
+        Returns the n nearest neighbors of p as a list of [point, distance]
+
+        With eps > 0 the search is approximate: each neighbor is at most
+        1+eps times farther from p than the true one. max_visits limits
+        the number of tree nodes checked, which bounds the time of a
+        query at the cost of accuracy.
+        """
         found = []
-        nnquery(self.root, p, n, found)
-        return found[:n]
+        if self.flat is not None:
+            flatkdtree.nnquery(self.flat, p, n, found, eps, max_visits,
+                               self.metric)
+            return found
+        neighbors = NeighborHeap(n)
+        if self.metric == 'euclidean':
+            nnquery(self.root, p, neighbors, 0, eps, max_visits)
+        else:
+            metric_nnquery(self.root, p, neighbors, self.metric, 0, eps,
+                           max_visits)
+        return [[t.point, d] for t, d in neighbors.neighbors()]
+    def query_batch(self, points, k=1, processes=None, eps=0, max_visits=None,
+                    order=None):
+        """
+        Returns the distances to and the input positions of the k nearest
+        neighbors of each of the (x, y) locations in points, as two lists
+        of rows (see flatkdtree.query_batch). eps and max_visits are as in
+        nearest_neighbor_query. With order set to 'hilbert' or 'morton'
+        the queries are answered in that spatial order (see
+        spatialorder.py), so that each worker process gets a compact part
+        of the plane; the rows are still returned in the given order.
+
+        Only flat trees share the queries among processes. On the linked
+        trees the points inserted after the tree was built are numbered
+        after the input, in the order they were inserted.
+        """
+        if order is None:
+            return self.knn_rows(points, k, processes, eps, max_visits)
+        perm = spatial_order(points, order)
+        dist, ind = self.knn_rows([points[i] for i in perm], k, processes,
+                                  eps, max_visits)
+        return unpermute(dist, perm), unpermute(ind, perm)
+    def knn_rows(self, points, k, processes, eps, max_visits):
+        if self.flat is not None:
+            return flatkdtree.query_batch(self.flat, points, k, processes,
+                                          eps, max_visits, self.metric)
+        dist, ind = [], []
+        for c in points:
+            neighbors = NeighborHeap(k)
+            if self.metric == 'euclidean':
+                nnquery(self.root, Point(c[0], c[1]), neighbors, 0, eps,
+                        max_visits)
+            else:
+                metric_nnquery(self.root, Point(c[0], c[1]), neighbors,
+                               self.metric, 0, eps, max_visits)
+            found = neighbors.neighbors()
+            pad = k-len(found)
+            dist.append([d for t, d in found] + [INF]*pad)
+            ind.append([t.index for t, d in found] + [-1]*pad)
+        return dist, ind
+    def range_query_batch(self, rects, processes=None, order=None):
+        """
+        Returns the input positions of the points in each of the
+        rectangles (see flatkdtree.range_query_batch). order is as in
+        query_batch and uses the centers of the rectangles. Only for flat
+        trees.
+        """
+        if self.flat is None:
+            raise Exception('range_query_batch needs a flat k-D tree')
+        if order is None:
+            return flatkdtree.range_query_batch(self.flat, rects, processes)
+        perm = spatial_order([((r[0][0]+r[0][1])/2, (r[1][0]+r[1][1])/2)
+                              for r in rects], order)
+        found = flatkdtree.range_query_batch(self.flat, [rects[i] for i in perm],
+                                             processes)
+        return unpermute(found, perm)
+
+def unpermute(rows, perm):
+    """
+    Returns rows in the original order, where rows[i] is the result for
+    item perm[i]
+    """
+    result = [None]*len(rows)
+    for row, i in zip(rows, perm):
+        result[i] = row
+    return result
 
 def kdtree1(points):
     """
     Creates a point k-D tree using a predefined order of points
     """
-    root = kDTreeNode(point=points[0], left=None, right=None)
-    for p in points[1:]:
-        node = kDTreeNode(point=p, left=None, right=None)
+    root = kDTreeNode(point=points[0], left=None, right=None, index=0)
+    for i in range(1, len(points)):
+        p = points[i]
+        node = kDTreeNode(point=p, left=None, right=None, index=i)
         p0, lr = query_kdtree(root, p, 0, False)
         if p0 is None and lr is None:   # skip duplicated
             continue
@@ -70,21 +407,32 @@ def kdtree1(points):
             p0.right = node
     return root
 
-def kdtree2(points, depth = 0):
+def kdtree2(points, indices=None, depth = 0):
     """
     Creates a point k-d tree using the median point to split the data
+
+    The median of each subset is found by selection over a permutation
+    of point indices, so the points are neither sorted nor copied at
+    each level and the tree is built in O(n log n) time. The index of
+    each node is taken from indices, or is the position of its point in
+    points if indices is None.
     """
     if len(points)==0:
         return
     k = len(points[0])
-    axis = depth % k
-    points.sort(key=lambda p: p[axis])
-    pivot = len(points)//2
-    # while pivot<len(points)-1 and points[pivot][axis]==points[pivot+1][axis]:
-    #     pivot += 1
-    return kDTreeNode(point=points[pivot],
-                      left=kdtree2(points[:pivot], depth+1),
-                      right=kdtree2(points[pivot+1:], depth+1))
+    coords = [[p[axis] for p in points] for axis in range(k)]
+    perm = list(range(len(points)))
+    def build(lo, hi, depth):
+        if lo >= hi:
+            return
+        pivot = (lo+hi)//2
+        select(perm, lo, hi, pivot, coords[depth % k])
+        i = perm[pivot]
+        return kDTreeNode(point=points[i],
+                          left=build(lo, pivot, depth+1),
+                          right=build(pivot+1, hi, depth+1),
+                          index=i if indices is None else indices[i])
+    return build(0, len(points), depth)
 
 def kdcompare(r, p, depth):
     """
@@ -118,29 +466,38 @@ def query_kdtree(t, p, depth=0, is_find_only=True):
                     -1 -- indicating p be the left child node of t (is_find_only is False)
                     1  -- indicating p be the right child node of t (is_find_only is False)
     """
-    if t is None:
-        return None, None
-    if t.point == p:
-        if is_find_only:
-            return t, None
+    while t is not None:
+        if t.point == p:
+            if is_find_only:
+                return t, None
+            else:
+                return None, None
+        lr = kdcompare(t, p, depth)
+        if lr<0:
+            child = t.left
         else:
-            return None, None
-    lr = kdcompare(t, p, depth)
-    if lr<0:
-        child = t.left
-    else:
-        child = t.right
-    if is_find_only==False and child is None:
-        return t, lr
-    return query_kdtree(child, p, depth+1, is_find_only)
+            child = t.right
+        if is_find_only==False and child is None:
+            return t, lr
+        t = child
+        depth += 1
+    return None, None
 
 def depth(t):
     """
     Returns the depth of the tree
     """
-    if t == None:
-        return -1
-    return max(depth(t.left)+1, depth(t.right)+1)
+    result = -1
+    stack = [(t, 0)]
+    while stack:
+        t, d = stack.pop()
+        if t is None:
+            continue
+        if d > result:
+            result = d
+        stack.append((t.left, d+1))
+        stack.append((t.right, d+1))
+    return result
 
 def range_query_orthogonal(t, rect, found, depth=0):
     """
@@ -155,23 +512,33 @@ def range_query_orthogonal(t, rect, found, depth=0):
       This function does not return any values. However, all the points
       found during the query process will be appended to list found.
     """
-    if t is None:
-        return
-    k = len(t.point)
-    axis = depth%k
-    x, y = t.point.x, t.point.y
-    if not (rect[0][0]>x or rect[0][1]<x or
-            rect[1][0]>y or rect[1][1]<y):
-        found.append(t.point)
-    if t.point[axis] < rect[axis][0]:
-        range_query_orthogonal(t.right, rect, found, depth+1)
-    elif t.point[axis] > rect[axis][1]:
-        range_query_orthogonal(t.left, rect, found, depth+1)
-    else:
-        range_query_orthogonal(t.left, rect, found, depth+1)
-        range_query_orthogonal(t.right, rect, found, depth+1)
+    found.extend(iter_range_orthogonal(t, rect, depth))
 
-def range_query_circular(t, p, r, found, depth=0):
+def iter_range_orthogonal(t, rect, depth=0):
+    """
+    Generates the points of subtree t in rectangle rect, given as
+    [ [xmin, xmax], [ymin, ymax] ], one at a time
+    """
+    stack = [(t, depth)]
+    while stack:
+        t, depth = stack.pop()
+        if t is None:
+            continue
+        k = len(t.point)
+        axis = depth%k
+        x, y = t.point.x, t.point.y
+        if not (rect[0][0]>x or rect[0][1]<x or
+                rect[1][0]>y or rect[1][1]<y):
+            yield t.point
+        if t.point[axis] < rect[axis][0]:
+            stack.append((t.right, depth+1))
+        elif t.point[axis] > rect[axis][1]:
+            stack.append((t.left, depth+1))
+        else:
+            stack.append((t.right, depth+1))
+            stack.append((t.left, depth+1))
+
+def range_query_circular(t, p, r, found, depth=0, rmin=0, metric='euclidean'):
     """
     Circular range search for points within a radius of r around p
 
@@ -179,57 +546,390 @@ def range_query_circular(t, p, r, found, depth=0):
       t: node of a point k-D tree
       p: a Point object around which query is performed
       found: a list to hold points found, declared outside
-      depth: the current depth on the k-D tree, mainly used internally
-             during recursive searching
+      depth: the depth of t on the k-D tree
+      rmin: inner radius. Points closer to p than rmin are left out, so
+            the query area is an annulus.
+      metric: name of the distance metric (see point.METRICS) that r and
+              rmin are measured in
 
     Output
       This function does not return any values. However, all the points
       found during the query process will be appended to list found.
     """
-    if t is None:
-        return
-    if kdcompare(t, Point(p.x-r, p.y-r), depth)>0:
-        range_query_circular(t.right, p, r, found, depth+1)
-        return
-    if kdcompare(t, Point(p.x+r, p.y+r), depth)<0:
-        range_query_circular(t.left, p, r, found, depth+1)
+    found.extend(iter_range_circular(t, p, r, depth, rmin, metric))
+
+def iter_range_circular(t, p, r, depth=0, rmin=0, metric='euclidean'):
+    """
+    Generates the points of subtree t whose distance to p is between
+    rmin and r, one at a time
+
+    The cell of each node is kept on the stack and a subtree is skipped
+    when its cell is entirely outside the circle of radius r or inside
+    the circle of radius rmin.
+    """
+    if metric != 'euclidean':
+        yield from iter_metric_circular(t, p, r, depth, rmin, metric)
         return
-    if p.distance(t.point) <= r:
-        found.append(t.point)
-    range_query_circular(t.left, p, r, found, depth+1)
-    range_query_circular(t.right, p, r, found, depth+1)
-    return
-
-
-def update_neighbors(p0, p, neighbors, n):
-    d = p0.distance(p)
-    for i, x in enumerate(neighbors):
-        if i == n:
-            return neighbors[n-1][1]
-        if d < x[1]:
-            neighbors.insert(i, [p0, d])
-            if len(neighbors) < n:
-                return INF
-            return neighbors[n-1][1]
-    neighbors.append([p0, d])
-    return INF
-
-def nnquery(t, p, n, found, depth=0, maxdist=INF):
+    px, py = p.x, p.y
+    r2, rmin2 = r*r, rmin*rmin
+    stack = [(t, depth, -INF, INF, -INF, INF)]  # node, depth, cell
+    while stack:
+        t, depth, x0, x1, y0, y1 = stack.pop()
+        if t is None:
+            continue
+        dx = x0-px if px < x0 else (px-x1 if px > x1 else 0.0)
+        dy = y0-py if py < y0 else (py-y1 if py > y1 else 0.0)
+        if dx*dx + dy*dy > r2:
+            continue
+        if rmin2 > 0:
+            dx, dy = max(px-x0, x1-px), max(py-y0, y1-py)
+            if dx*dx + dy*dy < rmin2:
+                continue
+        q = t.point
+        dx, dy = q.x-px, q.y-py
+        if rmin2 <= dx*dx + dy*dy <= r2:
+            yield q
+        if depth % 2 == 0:
+            stack.append((t.right, depth+1, q.x, x1, y0, y1))
+            stack.append((t.left, depth+1, x0, q.x, y0, y1))
+        else:
+            stack.append((t.right, depth+1, x0, x1, q.y, y1))
+            stack.append((t.left, depth+1, x0, x1, y0, q.y))
+
+def iter_metric_circular(t, p, r, depth, rmin, metric):
+    """
+    Generates the points of subtree t whose distance to p in the given
+    metric is between rmin and r. A subtree is skipped when the metric's
+    lower bound of the distance to its cell is larger than r.
+    """
+    distance, rect_distance = get_metric(metric)
+    px, py = p.x, p.y
+    stack = [(t, depth, -INF, INF, -INF, INF)]  # node, depth, cell
+    while stack:
+        t, depth, x0, x1, y0, y1 = stack.pop()
+        if t is None or rect_distance(px, py, x0, x1, y0, y1) > r:
+            continue
+        q = t.point
+        if rmin <= distance(px, py, q.x, q.y) <= r:
+            yield q
+        if depth % 2 == 0:
+            stack.append((t.right, depth+1, q.x, x1, y0, y1))
+            stack.append((t.left, depth+1, x0, q.x, y0, y1))
+        else:
+            stack.append((t.right, depth+1, x0, x1, q.y, y1))
+            stack.append((t.left, depth+1, x0, x1, y0, q.y))
+
+def tree_size(t):
+    """
+    Returns the number of nodes in the subtree t
+    """
+    n = 0
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        if t is not None:
+            n += 1
+            stack.append(t.left)
+            stack.append(t.right)
+    return n
+
+def tree_items(t):
+    """
+    Returns the list of points in the subtree t and the list of their
+    input positions
+    """
+    points, indices = [], []
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        if t is not None:
+            points.append(t.point)
+            indices.append(t.index)
+            stack.append(t.left)
+            stack.append(t.right)
+    return points, indices
+
+def insert_kdtree(t, p, n, alpha=ALPHA, index=None):
+    """
+    Inserts point p into a point k-D tree
+
+    If the new node is deeper than log(n)/log(1/alpha), the lowest
+    ancestor of the new node with one subtree larger than alpha times its
+    own size (the scapegoat) is found and its subtree is rebuilt using the
+    median split.
+
+    Input
+      t: root of the tree, or None
+      p: the point to insert
+      n: number of points in the tree after the insertion
+      alpha: balance factor between 0.5 and 1
+      index: input position of p
+
+    Output
+      The root of the tree, and False if p was already in the tree
+    """
+    node = kDTreeNode(point=p, left=None, right=None, index=index)
     if t is None:
-        return
-    if t.left == None and t.right == None:
-        maxdist = update_neighbors(t.point, p, found, n)
-        return
-    axis = depth % len(p)
-    if p[axis] < t.point[axis]:
-        nearer_tree, farther_tree = t.left, t.right
-    else:
-        nearer_tree, farther_tree = t.right, t.left
-    nnquery(nearer_tree, p, n, found, depth+1, maxdist)
-    maxdist = update_neighbors(t.point, p, found, n)
-    if abs(t.point[axis]-p[axis]) < maxdist: # must check the far side
-        nnquery(farther_tree, p, n, found, depth+1, maxdist)
-    return
+        return node, True
+    if find_kdtree(t, p)[0] is not None:
+        return t, False
+    path = []           # from the root to the parent of the new node
+    q, depth = t, 0
+    while True:
+        path.append(q)
+        if kdcompare(q, p, depth) < 0:
+            if q.left is None:
+                q.left = node
+                break
+            q = q.left
+        else:
+            if q.right is None:
+                q.right = node
+                break
+            q = q.right
+        depth += 1
+    if len(path) <= log(n)/log(1/alpha):
+        return t, True
+    size, child = 1, node
+    for depth in range(len(path)-1, -1, -1):
+        q = path[depth]
+        sibling = q.right if q.left is child else q.left
+        qsize = size + tree_size(sibling) + 1
+        if size > alpha*qsize:
+            points, indices = tree_items(q)
+            subtree = kdtree2(points, indices, depth)
+            if depth == 0:
+                return subtree, True
+            parent = path[depth-1]
+            if parent.left is q:
+                parent.left = subtree
+            else:
+                parent.right = subtree
+            return t, True
+        size, child = qsize, q
+    return t, True
+
+def find_kdtree(t, p, depth=0):
+    """
+    Finds the node that contains point p
+
+    Unlike query_kdtree, both subtrees are searched when p is on the
+    split line, since points equal to the split value may be on either
+    side in a tree built by kdtree2.
+
+    Output
+      The node, its parent, and its depth, or three None values if p is
+      not in the tree
+    """
+    stack = [(t, None, depth)]
+    while stack:
+        t, parent, depth = stack.pop()
+        if t is None:
+            continue
+        if t.point == p:
+            return t, parent, depth
+        axis = depth % len(p)
+        if p[axis] >= t.point[axis]:
+            stack.append((t.right, t, depth+1))
+        if p[axis] <= t.point[axis]:
+            stack.append((t.left, t, depth+1))
+    return None, None, None
+
+def find_extreme(t, parent, depth, axis, smallest):
+    """
+    Finds the node in subtree t with the smallest (or largest) value on
+    axis. Returns the node, its parent and its depth.
+    """
+    best = None
+    stack = [(t, parent, depth)]
+    while stack:
+        t, parent, depth = stack.pop()
+        if t is None:
+            continue
+        v = t.point[axis]
+        if best is None or (v < best[0] if smallest else v > best[0]):
+            best = (v, t, parent, depth)
+        if depth % len(t.point) != axis or not smallest:
+            stack.append((t.right, t, depth+1))
+        if depth % len(t.point) != axis or smallest:
+            stack.append((t.left, t, depth+1))
+    return best[1:]
+
+def delete_kdtree(t, p):
+    """
+    Deletes point p from a point k-D tree
+
+    A deleted internal node takes the point with the smallest value on
+    its split axis from its right subtree, or the largest one from its
+    left subtree if there is no right subtree, and that point is then
+    deleted from the subtree in the same way.
+
+    Output
+      The root of the tree, and False if p was not in the tree
+    """
+    node, parent, depth = find_kdtree(t, p)
+    if node is None:
+        return t, False
+    while True:
+        axis = depth % len(node.point)
+        if node.right is not None:
+            rep = find_extreme(node.right, node, depth+1, axis, True)
+        elif node.left is not None:
+            rep = find_extreme(node.left, node, depth+1, axis, False)
+        else:
+            if parent is None:
+                return None, True
+            if parent.left is node:
+                parent.left = None
+            else:
+                parent.right = None
+            return t, True
+        node.point, node.index = rep[0].point, rep[0].index
+        node, parent, depth = rep
+
+class NeighborHeap():
+    """
+    The n nearest neighbors found so far during a query.
+
+    The neighbors are kept in a max-heap of at most n items, so the
+    farthest one is replaced in O(log n) time and the distance to it is
+    the pruning radius of the query. Neighbors at the same distance are
+    kept in the order they were found.
+    """
+    def __init__(self, n):
+        self.n = n
+        self.heap = []      # (-distance, -seq, point)
+        self.seq = 0
+    def __len__(self):
+        return len(self.heap)
+    def maxdist(self):
+        """
+        Returns the distance to the farthest neighbor, or INF if fewer
+        than n neighbors have been found. With n < 1 it is -INF, so that
+        every point and subtree is pruned.
+        """
+        if self.n < 1:
+            return -INF
+        if len(self.heap) < self.n:
+            return INF
+        return -self.heap[0][0]
+    def push(self, p0, d):
+        """
+        Adds point p0 at distance d if it is one of the n nearest so far.
+        Returns the new pruning radius.
+        """
+        if self.n < 1:
+            return -INF
+        if len(self.heap) < self.n:
+            self.seq += 1
+            heappush(self.heap, (-d, -self.seq, p0))
+        elif d < -self.heap[0][0]:
+            self.seq += 1
+            heapreplace(self.heap, (-d, -self.seq, p0))
+        return self.maxdist()
+    def neighbors(self):
+        """
+        Returns the neighbors as a list of [point, distance], nearest first
+        """
+        return [[p0, -d] for d, s, p0 in sorted(self.heap, reverse=True)]
+
+def update_neighbors(p0, p, neighbors):
+    """
+    Offers point p0 as a neighbor of the query point p. Returns the
+    pruning radius of NeighborHeap neighbors.
+    """
+    return neighbors.push(p0, p0.distance(p))
+
+def nnquery(t, p, neighbors, depth=0, eps=0, max_visits=None):
+    """
+    Finds the nearest neighbors of point p in the subtree t
+
+    Input
+      t: node of a point k-D tree
+      p: query point
+      neighbors: a NeighborHeap that collects the nodes of the neighbors
+      depth: the current depth on the k-D tree
+      eps: approximation factor. Subtrees that cannot hold a point
+           closer than the pruning radius divided by 1+eps are skipped.
+      max_visits: stop after checking this many points, or None
+
+    Output
+      The pruning radius after searching t
+    """
+    maxdist = neighbors.maxdist()
+    # each entry is (node, depth, lower bound of the distance from p to
+    # the points under the node, True to only check the node's point)
+    stack = [(t, depth, 0, False)]
+    visits = INF if max_visits is None else max_visits
+    while stack and visits > 0:
+        t, depth, bound, point_only = stack.pop()
+        if t is None:
+            continue
+        if point_only:
+            visits -= 1
+            maxdist = neighbors.push(t, t.point.distance(p))
+            continue
+        if bound*(1+eps) >= maxdist:
+            continue
+        if t.left == None and t.right == None:
+            visits -= 1
+            maxdist = neighbors.push(t, t.point.distance(p))
+            continue
+        axis = depth % len(p)
+        if p[axis] < t.point[axis]:
+            nearer_tree, farther_tree = t.left, t.right
+        else:
+            nearer_tree, farther_tree = t.right, t.left
+        # the far side is checked after the nearer tree and the node's
+        # point, when the pruning radius is the smallest
+        stack.append((farther_tree, depth+1,
+                      max(bound, abs(t.point[axis]-p[axis])), False))
+        stack.append((t, depth, bound, True))
+        stack.append((nearer_tree, depth+1, bound, False))
+    return maxdist
+
+def metric_nnquery(t, p, neighbors, metric, depth=0, eps=0, max_visits=None):
+    """
+    Finds the nearest neighbors of point p in the subtree t using any
+    metric in point.METRICS
+
+    This works as nnquery, but the cell of each node is kept on the
+    stack and the lower bound of a subtree is the metric's distance from
+    p to the cell instead of the distance to the splitting line. As in
+    nnquery, neighbors collects the nodes of the neighbors.
+
+    Output
+      The pruning radius after searching t
+    """
+    distance, rect_distance = get_metric(metric)
+    px, py = p.x, p.y
+    maxdist = neighbors.maxdist()
+    visits = INF if max_visits is None else max_visits
+    # squared distances keep the guarantee on the distances themselves
+    # by shrinking with the square of 1+eps
+    shrink = (1+eps)*(1+eps) if metric == 'sqeuclidean' else 1+eps
+    # node, depth, lower bound of the distance to the cell, cell
+    stack = [(t, depth, 0, -INF, INF, -INF, INF)]
+    while stack and visits > 0:
+        t, depth, bound, x0, x1, y0, y1 = stack.pop()
+        if t is None or bound*shrink >= maxdist:
+            continue
+        visits -= 1
+        q = t.point
+        maxdist = neighbors.push(t, distance(px, py, q.x, q.y))
+        if depth % 2 == 0:
+            lcell, rcell = (x0, q.x, y0, y1), (q.x, x1, y0, y1)
+        else:
+            lcell, rcell = (x0, x1, y0, q.y), (x0, x1, q.y, y1)
+        children = []
+        for c, cell in ((t.left, lcell), (t.right, rcell)):
+            if c is not None:
+                children.append((rect_distance(px, py, *cell), cell, c))
+        # the nearer child is checked first
+        children.sort(key=lambda child: child[0], reverse=True)
+        for bound, cell, c in children:
+            stack.append((c, depth+1, bound) + cell)
+    return maxdist
 
 def tree_print(t):
     """
@@ -2,6 +2,13 @@
 A class for points used in the GIS Algorithms book.
 
 Change history
+  October 18, 2026
+    Point uses __slots__ and compares coordinates directly.
+    Add PointArray, a columnar sequence of points.
+    Add distance metrics (euclidean, sqeuclidean, haversine) and lower
+    bounds of the distance to a rectangle, used by the k-D trees
+    Add distance_matrix and cdist_chunked
+
   September 30, 2017
     Change __repr__ to return a new string like 'Point(x,y)'
 
@@ -25,10 +32,15 @@ Columbus, OH
 
 __author__ = 'Ningchuan Xiao <ncxiao@gmail.com>'
 
-from math import sqrt
+from array import array
+from math import sqrt, radians, degrees, sin, cos, asin, atan2
+
+INF = float('inf')
+EARTH_RADIUS = 6371.0088    # mean radius of the earth in kilometers
 
 class Point:
     '''A class for points in Cartesian coordinate systems.'''
+    __slots__ = ('x', 'y', 'key')
     def __init__(self, x=None, y=None, key=None):
         self.x = x
         self.y = y
@@ -44,41 +56,24 @@ class Point:
             return self.x==other.x and self.y==other.y
         return NotImplemented
     def __ne__(self, other):
-        result = self.__eq__(other)
-        if result is NotImplemented:
-            return result
-        return not result
+        if isinstance(other, Point):
+            return self.x!=other.x or self.y!=other.y
+        return NotImplemented
     def __lt__(self, other):
         if isinstance(other, Point):
-            if self.x<other.x:
-                return True
-            elif self.x==other.x and self.y<other.y:
-                return True
-            return False
+            return self.x<other.x or (self.x==other.x and self.y<other.y)
         return NotImplemented
     def __gt__(self, other):
         if isinstance(other, Point):
-            if self.x>other.x:
-                return True
-            elif self.x==other.x and self.y>other.y:
-                return True
-            return False
+            return self.x>other.x or (self.x==other.x and self.y>other.y)
         return NotImplemented
     def __ge__(self, other):
         if isinstance(other, Point):
-            if self > other or self == other:
-                return True
-            else:
-                return False
-            return False
+            return self.x>other.x or (self.x==other.x and self.y>=other.y)
         return NotImplemented
     def __le__(self, other):
         if isinstance(other, Point):
-            if self < other or self == other:
-                return True
-            else:
-                return False
-            return False
+            return self.x<other.x or (self.x==other.x and self.y<=other.y)
         return NotImplemented
     def isvalid(self):
         if not isinstance(self.x, (int, float)) \
@@ -102,3 +97,244 @@ class Point:
         return self.__str__()
     def distance(self, other):
         return sqrt((self.x-other.x)**2 + (self.y-other.y)**2)
+
+class PointArray:
+    '''
+    A columnar sequence of points.
+
+    The coordinates are kept in two arrays of doubles, x and y, and the
+    keys in a list, so a large set of points needs no Point objects.
+    Items are returned as new Point objects, and a PointArray can be used
+    wherever a list of points is expected.
+    '''
+    __slots__ = ('x', 'y', 'key')
+    def __init__(self, xs=(), ys=(), keys=None):
+        self.x = array('d', xs)
+        self.y = array('d', ys)
+        self.key = [None]*len(self.x) if keys is None else list(keys)
+        if len(self.x) != len(self.y) or len(self.x) != len(self.key):
+            raise Exception('xs, ys and keys must have the same length')
+    @classmethod
+    def from_points(cls, points):
+        return cls([p.x for p in points], [p.y for p in points],
+                   [p.key for p in points])
+    def __len__(self):
+        return len(self.x)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PointArray(self.x[i], self.y[i], self.key[i])
+        return Point(self.x[i], self.y[i], self.key[i])
+    def __iter__(self):
+        for x, y, key in zip(self.x, self.y, self.key):
+            yield Point(x, y, key)
+    def __repr__(self):
+        return 'PointArray(' + str(list(self)) + ')'
+    def __eq__(self, other):
+        if isinstance(other, PointArray):
+            return self.x == other.x and self.y == other.y
+        return NotImplemented
+    def __contains__(self, p):
+        return any(self.equal(p))
+    def append(self, p):
+        self.x.append(p.x)
+        self.y.append(p.y)
+        self.key.append(p.key)
+    def extend(self, points):
+        for p in points:
+            self.append(p)
+    def take(self, indices):
+        '''Returns a new PointArray of the points at the given positions'''
+        x, y, key = self.x, self.y, self.key
+        return PointArray([x[i] for i in indices], [y[i] for i in indices],
+                          [key[i] for i in indices])
+    def distance(self, other):
+        '''
+        Returns an array of distances from each point to point other, or
+        to the point at the same position if other is a PointArray
+        '''
+        if isinstance(other, PointArray):
+            if len(other) != len(self):
+                raise Exception('PointArrays must have the same length')
+            return array('d', [sqrt((x1-x2)*(x1-x2) + (y1-y2)*(y1-y2))
+                               for x1, y1, x2, y2 in
+                               zip(self.x, self.y, other.x, other.y)])
+        px, py = other.x, other.y
+        return array('d', [sqrt((x-px)*(x-px) + (y-py)*(y-py))
+                           for x, y in zip(self.x, self.y)])
+    def equal(self, p):
+        '''Returns a list of booleans, True where the point equals p'''
+        px, py = p.x, p.y
+        return [x == px and y == py for x, y in zip(self.x, self.y)]
+    def less(self, p):
+        '''Returns a list of booleans, True where the point is less than p'''
+        q = (p.x, p.y)
+        return [c < q for c in zip(self.x, self.y)]
+    def index(self, p):
+        '''Returns the position of the first point equal to p'''
+        px, py = p.x, p.y
+        for i, (x, y) in enumerate(zip(self.x, self.y)):
+            if x == px and y == py:
+                return i
+        raise ValueError(str(p) + ' is not in PointArray')
+    def argsort(self):
+        '''
+        Returns the positions of the points in the order of Point
+        comparison, by x first and then by y
+        '''
+        return sorted(range(len(self.x)), key=list(zip(self.x, self.y)).__getitem__)
+    def sort(self):
+        '''Sorts the points in place, in the order of Point comparison'''
+        order = self.argsort()
+        self.x = array('d', [self.x[i] for i in order])
+        self.y = array('d', [self.y[i] for i in order])
+        self.key = [self.key[i] for i in order]
+
+def euclidean(x1, y1, x2, y2):
+    dx, dy = x1-x2, y1-y2
+    return sqrt(dx*dx + dy*dy)
+
+def sqeuclidean(x1, y1, x2, y2):
+    dx, dy = x1-x2, y1-y2
+    return dx*dx + dy*dy
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Returns the great-circle distance in kilometers between two locations
+    given as longitude and latitude in degrees
+    """
+    lat1, lat2 = radians(lat1), radians(lat2)
+    a = sin((lat2-lat1)/2)**2 + \
+        cos(lat1)*cos(lat2)*sin(radians(lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS*asin(min(1.0, sqrt(a)))
+
+def euclidean_rect(x, y, x0, x1, y0, y1):
+    """
+    Returns the smallest distance from (x, y) to a point in the rectangle
+    [x0, x1] x [y0, y1]. The bounds can be infinite.
+    """
+    dx = x0-x if x < x0 else (x-x1 if x > x1 else 0.0)
+    dy = y0-y if y < y0 else (y-y1 if y > y1 else 0.0)
+    return sqrt(dx*dx + dy*dy)
+
+def sqeuclidean_rect(x, y, x0, x1, y0, y1):
+    dx = x0-x if x < x0 else (x-x1 if x > x1 else 0.0)
+    dy = y0-y if y < y0 else (y-y1 if y > y1 else 0.0)
+    return dx*dx + dy*dy
+
+def haversine_rect(lon, lat, lon0, lon1, lat0, lat1):
+    """
+    Returns the smallest great-circle distance in kilometers from (lon,
+    lat) to a location with a longitude in [lon0, lon1] and a latitude in
+    [lat0, lat1], all in degrees. The bounds can be infinite; longitudes
+    are taken to be in [-180, 180].
+
+    If lon is in the range of longitudes the nearest location is due
+    north or south. Otherwise it is on one of the two bounding meridians,
+    either at an end or where the great circle through (lon, lat) meets
+    the meridian at a right angle.
+    """
+    lon0, lon1 = max(lon0, -180.0), min(lon1, 180.0)
+    lat0, lat1 = max(lat0, -90.0), min(lat1, 90.0)
+    if lon1-lon0 >= 360 or (lon-lon0) % 360 <= lon1-lon0:
+        if lat < lat0:
+            return EARTH_RADIUS*radians(lat0-lat)
+        if lat > lat1:
+            return EARTH_RADIUS*radians(lat-lat1)
+        return 0.0
+    d = INF
+    phi = radians(lat)
+    for m in (lon0, lon1):
+        d = min(d, haversine(lon, lat, m, lat0), haversine(lon, lat, m, lat1))
+        dl = radians(lon-m)
+        if cos(dl) > 0:
+            foot = atan2(sin(phi), cos(phi)*cos(dl))
+            if radians(lat0) < foot < radians(lat1):
+                d = min(d, haversine(lon, lat, m, degrees(foot)))
+    return d
+
+# distance function and lower bound of the distance to a rectangle
+METRICS = {
+    'euclidean': (euclidean, euclidean_rect),
+    'sqeuclidean': (sqeuclidean, sqeuclidean_rect),
+    'haversine': (haversine, haversine_rect),
+}
+
+def get_metric(metric):
+    """
+    Returns the distance function and rectangle bound of a metric name
+    """
+    if metric not in METRICS:
+        raise Exception('Unknown metric: ' + str(metric))
+    return METRICS[metric]
+
+def coordinates(points):
+    """
+    Returns the x and y coordinates of a PointArray, or a sequence of
+    Point objects or (x, y) pairs, as two sequences
+    """
+    if isinstance(points, PointArray):
+        return points.x, points.y
+    return [p[0] for p in points], [p[1] for p in points]
+
+def distance_rows(xs, ys, metric='euclidean'):
+    """
+    Returns a function that computes the distances from a location
+    (px, py) to all the locations in xs, ys as an array of doubles
+    """
+    if metric == 'euclidean':
+        def row(px, py):
+            return array('d', [sqrt((x-px)*(x-px) + (y-py)*(y-py))
+                               for x, y in zip(xs, ys)])
+    elif metric == 'sqeuclidean':
+        def row(px, py):
+            return array('d', [(x-px)*(x-px) + (y-py)*(y-py)
+                               for x, y in zip(xs, ys)])
+    elif metric == 'haversine':
+        # the sines and cosines of the columns are only computed once
+        lons = [radians(x) for x in xs]
+        lats = [radians(y) for y in ys]
+        coslats = [cos(lat) for lat in lats]
+        def row(px, py):
+            lon, lat = radians(px), radians(py)
+            c = cos(lat)
+            return array('d', [2*EARTH_RADIUS*asin(min(1.0, sqrt(
+                sin((lat2-lat)/2)**2 + c*c2*sin((lon2-lon)/2)**2)))
+                for lon2, lat2, c2 in zip(lons, lats, coslats)])
+    else:
+        distance = get_metric(metric)[0]
+        def row(px, py):
+            return array('d', [distance(px, py, x, y) for x, y in zip(xs, ys)])
+    return row
+
+def cdist_chunked(a, b, metric='euclidean', max_items=1<<20):
+    """
+    Computes the distances between two collections of points in blocks
+    of rows, so that only one block is held in memory at a time
+
+    Input
+      a, b: PointArray objects, or sequences of Point objects or (x, y)
+      metric: name of the distance metric (see METRICS)
+      max_items: the largest number of distances in a block
+
+    Output
+      A generator of (start, rows), where rows is a list of arrays of
+      doubles. rows[i][j] is the distance between a[start+i] and b[j].
+    """
+    ax, ay = coordinates(a)
+    bx, by = coordinates(b)
+    row = distance_rows(bx, by, metric)
+    size = max(1, max_items // max(len(bx), 1))
+    for start in range(0, len(ax), size):
+        yield start, [row(px, py) for px, py in
+                      zip(ax[start:start+size], ay[start:start+size])]
+
+def distance_matrix(a, b=None, metric='euclidean'):
+    """
+    Returns the matrix of distances between the points of a and b (or
+    between the points of a if b is None) as a list of rows, each an
+    array of doubles. See cdist_chunked for the input.
+    """
+    rows = []
+    for start, block in cdist_chunked(a, a if b is None else b, metric):
+        rows.extend(block)
+    return rows
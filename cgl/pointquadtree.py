@@ -4,6 +4,12 @@ Point quadtree
 The class PointQuadTree is currently just a wrapper around
 some of the functions developed in the GIS Algorithms book.
 
+The class prquadtree is a point-region (PR) quadtree. Its cells are
+fixed: each one is split into four equal quadrants when its bucket holds
+more than capacity points, until max_depth is reached. The shape of the
+tree therefore does not depend on the order of the points, and the cells
+at depth d are the tiles of a 2^d by 2^d grid over the bounds.
+
 Contact:
 Ningchuan Xiao
 The Ohio State University
@@ -12,12 +18,15 @@ Columbus, OH
 
 __author__ = "Ningchuan Xiao <ncxiao@gmail.com>"
 
-__all__ = ['pointquadtree']
+__all__ = ['pointquadtree', 'prquadtree']
 
 INF = float('inf')
 
-from cgl.point import Point
-from cgl.kdtree import update_neighbors
+from bisect import bisect_left
+from heapq import heappush, heappop
+from itertools import islice
+from cgl.point import Point, euclidean_rect
+from cgl.kdtree import NeighborHeap, update_neighbors
 
 class PQuadTreeNode():
     def __init__(self,point,nw=None,ne=None,se=None,sw=None):
@@ -33,13 +42,32 @@ class PQuadTreeNode():
             self.se==None and self.sw==None
 
 class pointquadtree():
-    def __init__(self, points):
-        self.root = PQuadTreeNode(point = points[0])
-        for p in points[1:]:
-            self.insert_pqtree(p)
+    """
+    Point quadtree
+
+    pqtree_type can be 'balanced' (the default), where the tree is built
+    at once with the median point of each subset as its pivot, or
+    'unbalanced', where the points are inserted in the given order.
+    Points can be inserted later in both cases.
+    """
+    def __init__(self, points, pqtree_type='balanced'):
+        self.root = None
+        if pqtree_type == 'balanced':
+            self.root = pqtree_balanced(points)
+        else:
+            for p in points:
+                self.insert_pqtree(p)
     def insert_pqtree(self, p):
-        n = search_pqtree(self.root, p, False)
+        """
+        Inserts point p. Returns False if p is already in the tree.
+        """
         node = PQuadTreeNode(point=p)
+        if self.root is None:
+            self.root = node
+            return True
+        n = search_pqtree(self.root, p, False)
+        if n is None:   # p is in the tree
+            return False
         if p.x < n.point.x and p.y < n.point.y:
             n.sw = node
         elif p.x < n.point.x and p.y >= n.point.y:
@@ -48,82 +76,297 @@ class pointquadtree():
             n.se = node
         else:
             n.ne = node
+        return True
+    def delete(self, p):
+        """
+        Removes point p. Returns False if p is not in the tree.
+
+        The points under the node of p are built into a balanced subtree
+        that takes the place of the node. They all lie in the region of
+        the node, so the rest of the tree is not touched.
+        """
+        parent, quad, n = self.find_parent(p)
+        if n is None:
+            return False
+        self.remove_node(parent, quad, n)
+        return True
+    def move(self, p, new_xy):
+        """
+        Moves point p to new_xy, given as (x, y)
+
+        Output
+          The Point at the new location, which keeps the key of the point
+          stored in the tree, or None if p is not in the tree or another
+          point is already at new_xy.
+        """
+        parent, quad, n = self.find_parent(p)
+        if n is None:
+            return None
+        q = Point(new_xy[0], new_xy[1], n.point.key)
+        if q != n.point and search_pqtree(self.root, q, True) is not None:
+            return None
+        self.remove_node(parent, quad, n)
+        self.insert_pqtree(q)
+        return q
+    def find_parent(self, p):
+        """
+        Returns the parent of the node holding p, the name of the quadrant
+        of the parent that holds it, and the node itself. The node is None
+        if p is not in the tree, and the parent is None if it is the root.
+        """
+        parent, quad, n = None, None, self.root
+        while n is not None and n.point != p:
+            parent, quad = n, ['nw', 'ne', 'se', 'sw'][pqcompare(n, p)]
+            n = getattr(parent, quad)
+        return parent, quad, n
+    def remove_node(self, parent, quad, n):
+        rest = []
+        stack = [n.nw, n.ne, n.se, n.sw]
+        while stack:
+            t = stack.pop()
+            if t is not None:
+                rest.append(t.point)
+                stack.extend((t.nw, t.ne, t.se, t.sw))
+        subtree = pqtree_balanced(rest)
+        if parent is None:
+            self.root = subtree
+        else:
+            setattr(parent, quad, subtree)
     def search_pqtree(self, p, is_find_only=True):
         return search_pqtree(self.root, p, is_find_only)
+    def depth(self):
+        return pq_depth(self.root)
     def range_query(self, p, r):
         return range_query(self.root, p, r)
+    def iter_range_circular(self, p, r, limit=None):
+        """
+        Generates the points within a radius of r around p one at a time.
+        Stops after limit points if limit is given.
+        """
+        return islice(iter_range_circular(self.root, p, r), limit)
+    def range_query_orthogonal(self, rect):
+        return list(iter_range_orthogonal(self.root, rect))
+    def iter_range_orthogonal(self, rect, limit=None):
+        """
+        Generates the points in rect, given as [ [xmin, xmax], [ymin, ymax] ],
+        one at a time. Stops after limit points if limit is given.
+        """
+        return islice(iter_range_orthogonal(self.root, rect), limit)
+    def range_query_polygon(self, polygon):
+        return list(iter_range_polygon(self.root, polygon))
+    def iter_range_polygon(self, polygon, limit=None):
+        """
+        Generates the points inside polygon one at a time. Stops after
+        limit points if limit is given. See iter_range_polygon for the
+        forms polygon can take.
+        """
+        return islice(iter_range_polygon(self.root, polygon), limit)
     def nearest_neighbor_query(self, p, n=1):
         return pq_nearest_neighbor_query(self.root, p, n)
 
+def pqtree_balanced(points):
+    """
+    Creates a point quadtree using the median point to split the data
+
+    The points are sorted by x and then by y once, and the subsets handed
+    down to the quadrants stay sorted. The pivot of each subset has the x
+    of its middle point, so at most half of the subset is to the west of
+    it. Points with the same x as the pivot go east, so when x repeats
+    the pivot is chosen in that run of points (see run_pivot) to split
+    the east side evenly between SE and NE. No quadrant then holds more
+    than three quarters of the subset, and the depth stays O(log n).
+    The tree is built in O(n log n) time if the x values are distinct,
+    and O(n log^2 n) otherwise. Points equal to one already in the tree
+    are left out, as in pointquadtree.insert_pqtree.
+    """
+    ordered = sorted(points)
+    unique = [p for i, p in enumerate(ordered) if i == 0 or p != ordered[i-1]]
+    if len(unique) == 0:
+        return None
+    root = None
+    names = ['nw', 'ne', 'se', 'sw']   # in the order of pqcompare
+    # each entry is (sorted points, parent node, quadrant of the parent)
+    stack = [(unique, None, None)]
+    while stack:
+        subset, parent, quad = stack.pop()
+        mid = len(subset)//2
+        x = subset[mid].x
+        lo, hi = mid, mid+1
+        while lo > 0 and subset[lo-1].x == x:
+            lo -= 1
+        while hi < len(subset) and subset[hi].x == x:
+            hi += 1
+        if hi-lo > 1:
+            mid = run_pivot(subset, lo, hi)
+        node = PQuadTreeNode(point=subset[mid])
+        if parent is None:
+            root = node
+        else:
+            setattr(parent, quad, node)
+        quads = [[], [], [], []]
+        for i, p in enumerate(subset):
+            if i != mid:
+                quads[pqcompare(node, p)].append(p)
+        for i in range(4):
+            if quads[i]:
+                stack.append((quads[i], node, names[i]))
+    return root
+
+def run_pivot(subset, lo, hi):
+    """
+    Returns the position of the pivot in subset[lo:hi], a run of points
+    with the same x sorted by y. The points from lo on are east of any
+    pivot in the run, and those with a smaller y than the pivot go to SE.
+    The pivot is the one that splits them most evenly between SE and NE.
+    """
+    east = sorted(p.y for p in subset[hi:])
+    half = (len(subset)-lo-1) / 2
+    best, pos = INF, lo
+    for k in range(lo, hi):
+        se = k-lo + bisect_left(east, subset[k].y)
+        if abs(se-half) < best:
+            best, pos = abs(se-half), k
+    return pos
+
 def search_pqtree(q, p, is_find_only):
-    if q is None:
-        return
-    if q.point == p:
-        if is_find_only:
+    """
+    Searches for point p from node q
+
+    Output
+      The node holding p if is_find_only is True. Otherwise the node that
+      p would be inserted under, or None if p is already in the tree.
+    """
+    while q is not None:
+        if q.point == p:
+            if is_find_only:
+                return q
+            else:
+                return
+        dx,dy = 0,0
+        if p.x >= q.point.x:
+            dx = 1
+        if p.y >= q.point.y:
+            dy = 1
+        qnum = dx+dy*2
+        child = [q.sw, q.se, q.nw, q.ne][qnum]
+        if child is None and not is_find_only:
             return q
-        else:
-            return
-    dx,dy = 0,0
-    if p.x >= q.point.x:
-        dx = 1
-    if p.y >= q.point.y:
-        dy = 1
-    qnum = dx+dy*2
-    child = [q.sw, q.se, q.nw, q.ne][qnum]
-    if child is None and not is_find_only:
-        return q
-    return search_pqtree(child, p, is_find_only)
+        q = child
+
+def pq_depth(t):
+    """
+    Returns the depth of the subtree t
+    """
+    if t is None:
+        return -1
+    result = 0
+    stack = [(t, 0)]
+    while stack:
+        t, d = stack.pop()
+        result = max(result, d)
+        for child in (t.nw, t.ne, t.se, t.sw):
+            if child is not None:
+                stack.append((child, d+1))
+    return result
 
 def range_query(t, p, r):
     """
     Circular range query
     """
-    def rquery(t, p, r, found):
-        if t is None:
-            return
+    return list(iter_range_circular(t, p, r))
+
+def iter_range_circular(t, p, r):
+    """
+    Generates the points of subtree t within a radius of r around p. Only
+    the quadrants that overlap the square around the circle are visited.
+    """
+    xmin, xmax = p.x-r, p.x+r
+    ymin, ymax = p.y-r, p.y+r
+    for p0 in iter_range_orthogonal(t, [[xmin, xmax], [ymin, ymax]]):
+        if p.distance(p0) <= r:
+            yield p0
+
+def iter_range_orthogonal(t, rect):
+    """
+    Generates the points of subtree t in rectangle rect, given as
+    [ [xmin, xmax], [ymin, ymax] ], one at a time
+
+    The quadrants of a node are the four boxes around its point. A
+    quadrant is only visited if its box overlaps rect, and the boxes of
+    the ancestors have already been checked on the way down.
+    """
+    (xmin, xmax), (ymin, ymax) = rect
+    stack = [t] if t is not None else []
+    while stack:
+        t = stack.pop()
         x, y = t.point.x, t.point.y
-        xmin, xmax = p.x-r, p.x+r
-        ymin, ymax = p.y-r, p.y+r
-        if x<xmin and y<ymin:
-            rquery(t.ne, p, r, found)
-            return
-        elif x<xmin and y>ymax:
-            rquery(t.se, p, r, found)
-            return
-        elif x>xmax and y>ymax:
-            rquery(t.sw, p, r, found)
-            return
-        elif x>xmax and y<ymin:
-            rquery(t.nw, p, r, found)
-            return
+        if xmin <= x <= xmax and ymin <= y <= ymax:
+            yield t.point
+        west = xmin < x     # points west of the node have x' < x
+        east = xmax >= x
+        south = ymin < y
+        north = ymax >= y
+        if t.sw is not None and west and south:
+            stack.append(t.sw)
+        if t.se is not None and east and south:
+            stack.append(t.se)
+        if t.ne is not None and east and north:
+            stack.append(t.ne)
+        if t.nw is not None and west and north:
+            stack.append(t.nw)
+
+def polygon_rings(polygon):
+    """
+    Returns the rings of polygon as lists of (x, y)
+
+    Input
+      polygon: a ring given as a list of (x, y) or Point objects, a list
+               of rings, any nesting of them, or a Polygon or MultiPolygon
+               feature read by cgl.util.shapex
+    """
+    if isinstance(polygon, dict):
+        polygon = polygon['geometry']['coordinates']
+    rings = []
+    stack = [polygon]
+    while stack:
+        c = stack.pop()
+        if len(c) and isinstance(c[0][0], (int, float)):
+            rings.append([(q[0], q[1]) for q in c])
         else:
-            if x < xmin:
-                rquery(t.ne, p, r, found)  # right points only
-                rquery(t.se, p, r, found)
-                return
-            if y < ymin:
-                rquery(t.ne, p, r, found)  # above points only
-                rquery(t.nw, p, r, found)
-                return
-            if x > xmax:
-                rquery(t.nw, p, r, found)  # left points only
-                rquery(t.sw, p, r, found)
-                return
-            if y > ymax:
-                rquery(t.se, p, r, found)  # below points only
-                rquery(t.sw, p, r, found)
-                return
-        if p.distance(t.point) <= r:
-            found.append(t.point)
-        rquery(t.nw, p, r, found)
-        rquery(t.ne, p, r, found)
-        rquery(t.se, p, r, found)
-        rquery(t.sw, p, r, found)
+            stack.extend(c)
+    return rings
+
+def point_in_polygon(x, y, rings):
+    """
+    Returns True if (x, y) is inside the rings under the even-odd rule,
+    so holes and separate parts need no special treatment. Points on the
+    boundary may fall on either side.
+    """
+    inside = False
+    for ring in rings:
+        xj, yj = ring[-1]
+        for xi, yi in ring:
+            if (yi > y) != (yj > y) and x < (xj-xi)*(y-yi)/(yj-yi)+xi:
+                inside = not inside
+            xj, yj = xi, yi
+    return inside
+
+def iter_range_polygon(t, polygon):
+    """
+    Generates the points of subtree t inside polygon. The tree is pruned
+    by the bounding box of the polygon, and only the points in the box
+    are tested against the rings. See polygon_rings for the forms that
+    polygon can take.
+    """
+    rings = polygon_rings(polygon)
+    if len(rings) == 0:
         return
-    found = []
-    if t is not None:
-        rquery(t, p, r, found)
-    return found
+    xs = [q[0] for ring in rings for q in ring]
+    ys = [q[1] for ring in rings for q in ring]
+    rect = [[min(xs), max(xs)], [min(ys), max(ys)]]
+    for p0 in iter_range_orthogonal(t, rect):
+        if point_in_polygon(p0.x, p0.y, rings):
+            yield p0
 
 # returns the quad of t where p is located
 # 0-NW, 1-NE, 2-SE, 3-SW
@@ -137,24 +380,251 @@ def pqcompare(t, p):
     else:
         return 1
 
-def pq_nnquery(t, p, n, found, pqmaxdist=INF):
+def pq_nnquery(t, p, neighbors):
+    """
+    Finds the nearest neighbors of point p in the subtree t
+
+    Each node owns the region cut out by the points of its ancestors, and
+    its quadrants split that region at its own point. The nodes are
+    visited best first, in the order of the smallest distance from p to
+    their regions, and all of them share the pruning radius held by
+    neighbors. The search stops as soon as the nearest region left is
+    farther than that radius.
+
+    Input
+      t: node of a point quadtree
+      p: query point
+      neighbors: a NeighborHeap that collects the neighbors
+
+    Output
+      The pruning radius after searching t
+    """
     if t is None:
-        return
-    if t.is_leaf():
-        pqmaxdist = update_neighbors(t.point, p, found, n)
-        return
-    quad_index = pqcompare(t, p)
-    quads = [t.nw, t.ne, t.se, t.sw]
-    pq_nnquery(quads[quad_index], p, n, found, pqmaxdist)
-    pqmaxdist = update_neighbors(t.point, p, found, n)
-    # check if the circle of pqmaxdist overlap with other quads
-    for i in range(4):
-        if i != quad_index:
-            if abs(t.point.x-p.x) < pqmaxdist or abs(t.point.y-p.y) < pqmaxdist:
-                pq_nnquery(quads[i], p, n, found, pqmaxdist)
-    return
+        return neighbors.maxdist()
+    # each entry is (distance to the region, seq, node, region), where the
+    # region is (xmin, xmax, ymin, ymax) and can be unbounded
+    heap = [(0.0, 0, t, (-INF, INF, -INF, INF))]
+    seq = 1
+    while heap:
+        d, _, t, region = heappop(heap)
+        if d > neighbors.maxdist():
+            break
+        update_neighbors(t.point, p, neighbors)
+        x0, x1, y0, y1 = region
+        x, y = t.point.x, t.point.y
+        for q, r in ((t.nw, (x0, x, y, y1)), (t.ne, (x, x1, y, y1)),
+                     (t.se, (x, x1, y0, y)), (t.sw, (x0, x, y0, y))):
+            if q is not None:
+                dq = euclidean_rect(p.x, p.y, *r)
+                if dq <= neighbors.maxdist():
+                    heappush(heap, (dq, seq, q, r))
+                    seq += 1
+    return neighbors.maxdist()
 
 def pq_nearest_neighbor_query(t, p, n=1):
-    nearest_neighbors = []
-    pq_nnquery(t, p, n, nearest_neighbors)
-    return nearest_neighbors[:n]
+    nearest_neighbors = NeighborHeap(n)
+    pq_nnquery(t, p, nearest_neighbors)
+    return nearest_neighbors.neighbors()
+
+class PRQuadTreeNode():
+    """
+    Cell (xmin, ymin, xmax, ymax) of a PR quadtree. A leaf has a bucket of
+    points and no children; an internal node has four children in the
+    order NW, NE, SE, SW and no points. Points on the lines that split a
+    cell belong to the quadrants to the east and north of them.
+    """
+    def __init__(self, xmin, ymin, xmax, ymax, depth=0):
+        self.xmin, self.ymin = xmin, ymin
+        self.xmax, self.ymax = xmax, ymax
+        self.depth = depth
+        self.points = []
+        self.quads = None
+    def __repr__(self):
+        return str((self.xmin, self.ymin, self.xmax, self.ymax))
+    def is_leaf(self):
+        return self.quads is None
+    def split(self):
+        """
+        Creates the four children and moves the points down to them
+        """
+        cx = (self.xmin+self.xmax)/2
+        cy = (self.ymin+self.ymax)/2
+        d = self.depth+1
+        self.quads = [PRQuadTreeNode(self.xmin, cy, cx, self.ymax, d),
+                      PRQuadTreeNode(cx, cy, self.xmax, self.ymax, d),
+                      PRQuadTreeNode(cx, self.ymin, self.xmax, cy, d),
+                      PRQuadTreeNode(self.xmin, self.ymin, cx, cy, d)]
+        for p in self.points:
+            self.quads[prcompare(self, p)].points.append(p)
+        self.points = None
+        return self.quads
+
+def prcompare(t, p):
+    """
+    Returns the quad of cell t where p is located, using the same
+    numbering and tie rule as pqcompare: 0-NW, 1-NE, 2-SE, 3-SW
+    """
+    cx = (t.xmin+t.xmax)/2
+    cy = (t.ymin+t.ymax)/2
+    if p.x<cx and p.y<cy:
+        return 3
+    elif p.x<cx:
+        return 0
+    elif p.y<cy:
+        return 2
+    else:
+        return 1
+
+class prquadtree():
+    """
+    PR (point-region) quadtree with bucketed leaves
+
+    Input
+      points: a list of Point objects
+      bounds: (xmin, ymin, xmax, ymax) covered by the root cell. If None,
+              the smallest square that holds the points is used. Points
+              inserted later must fall inside the bounds.
+      capacity: the largest number of points in a leaf, unless the leaf
+                is at max_depth
+      max_depth: the depth at which cells are no longer split
+    """
+    def __init__(self, points, bounds=None, capacity=8, max_depth=16):
+        if capacity < 1:
+            raise Exception('capacity must be at least 1')
+        if bounds is None:
+            bounds = square_bounds(points)
+        xmin, ymin, xmax, ymax = bounds
+        if not (xmin < xmax and ymin < ymax):
+            raise Exception('Empty bounds: ' + str(bounds))
+        self.bounds = (xmin, ymin, xmax, ymax)
+        self.capacity = capacity
+        self.max_depth = max_depth
+        self.root = PRQuadTreeNode(xmin, ymin, xmax, ymax)
+        self.size = 0
+        ordered = sorted(points)
+        unique = [p for i, p in enumerate(ordered) if i == 0 or p != ordered[i-1]]
+        for p in unique:
+            self.check_bounds(p)
+        self.root.points = unique
+        self.size = len(unique)
+        # split the cells top-down, each one needs a single pass
+        stack = [self.root]
+        while stack:
+            t = stack.pop()
+            if len(t.points) > capacity and t.depth < max_depth:
+                stack.extend(t.split())
+    def __len__(self):
+        return self.size
+    def check_bounds(self, p):
+        xmin, ymin, xmax, ymax = self.bounds
+        if not (xmin <= p.x <= xmax and ymin <= p.y <= ymax):
+            raise Exception('Point outside the bounds of the tree: ' + str(p))
+    def find_leaf(self, p):
+        """
+        Returns the leaf whose cell holds point p
+        """
+        t = self.root
+        while t.quads is not None:
+            t = t.quads[prcompare(t, p)]
+        return t
+    def insert(self, p):
+        """
+        Inserts point p. Returns False if p is already in the tree.
+        """
+        self.check_bounds(p)
+        t = self.find_leaf(p)
+        if p in t.points:
+            return False
+        t.points.append(p)
+        self.size += 1
+        while len(t.points) > self.capacity and t.depth < self.max_depth:
+            t.split()
+            t = t.quads[prcompare(t, p)]
+        return True
+    def depth(self):
+        result = 0
+        stack = [self.root]
+        while stack:
+            t = stack.pop()
+            result = max(result, t.depth)
+            if t.quads is not None:
+                stack.extend(t.quads)
+        return result
+    def leaves(self):
+        """
+        Yields the leaves, which are the tiles of the tree
+        """
+        stack = [self.root]
+        while stack:
+            t = stack.pop()
+            if t.quads is None:
+                yield t
+            else:
+                stack.extend(reversed(t.quads))
+    def range_query(self, p, r):
+        return pr_range_query(self.root, p, r)
+    def nearest_neighbor_query(self, p, n=1):
+        return pr_nearest_neighbor_query(self.root, p, n)
+
+def square_bounds(points):
+    """
+    Returns the smallest square (xmin, ymin, xmax, ymax) that holds points
+    """
+    if len(points) == 0:
+        return (0.0, 0.0, 1.0, 1.0)
+    xmin = min(p.x for p in points)
+    ymin = min(p.y for p in points)
+    side = max(max(p.x for p in points)-xmin, max(p.y for p in points)-ymin)
+    if side == 0:
+        side = 1.0
+    return (xmin, ymin, xmin+side, ymin+side)
+
+def cell_distance(t, p):
+    """
+    Returns the smallest distance from point p to the cell of node t
+    """
+    return euclidean_rect(p.x, p.y, t.xmin, t.xmax, t.ymin, t.ymax)
+
+def pr_range_query(t, p, r):
+    """
+    Circular range query on the PR quadtree rooted at t
+    """
+    found = []
+    stack = [t]
+    while stack:
+        t = stack.pop()
+        if cell_distance(t, p) > r:
+            continue
+        if t.quads is None:
+            for p0 in t.points:
+                if p.distance(p0) <= r:
+                    found.append(p0)
+        else:
+            stack.extend(t.quads)
+    return found
+
+def pr_nearest_neighbor_query(t, p, n=1):
+    """
+    Finds the n nearest neighbors of point p in the PR quadtree rooted at t
+
+    The cells are visited best first, in the order of their distance to p,
+    and the search stops when the nearest cell left is farther than the
+    n-th neighbor found so far.
+    """
+    neighbors = NeighborHeap(n)
+    heap = [(0.0, 0, t)]
+    seq = 1
+    while heap:
+        d, _, t = heappop(heap)
+        if d > neighbors.maxdist():
+            break
+        if t.quads is None:
+            for p0 in t.points:
+                update_neighbors(p0, p, neighbors)
+        else:
+            for q in t.quads:
+                dq = cell_distance(q, p)
+                if dq <= neighbors.maxdist():
+                    heappush(heap, (dq, seq, q))
+                    seq += 1
+    return neighbors.neighbors()
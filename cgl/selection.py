@@ -0,0 +1,72 @@
+"""
+Selection over index permutations
+
+Median-split trees only need the median of each subset, not a complete
+ordering. The function select finds it in linear expected time using
+the sampling method of Floyd and Rivest: two values that bracket the
+k-th smallest one are taken from a sorted sample, and a single pass over
+the range splits it into the values below, between and above them.
+The k-th value almost always falls into the small middle band, which is
+then sorted. If the bracketing fails too often the range is sorted
+instead, so the worst case is O(n log n).
+
+Contact:
+Ningchuan Xiao
+The Ohio State University
+Columbus, OH
+"""
+
+__author__ = "Ningchuan Xiao <ncxiao@gmail.com>"
+
+from math import sqrt
+
+__all__ = ['select']
+
+SMALL = 512   # ranges this short are simply sorted
+
+def select(perm, lo, hi, k, key):
+    """
+    Partial sort of an index permutation
+
+    Input
+      perm: a list of indices
+      lo, hi: the range perm[lo:hi] to work on
+      k: the position to select, lo <= k < hi
+      key: a sequence so that key[i] is the value of index i
+
+    Output
+      This function does not return any values. The range perm[lo:hi] is
+      rearranged so that perm[k] is the index that would be at position k
+      if the range were sorted by key, all indices before k have a value
+      no greater than key[perm[k]], and all indices after k have a value
+      no less than key[perm[k]].
+    """
+    budget = 4
+    while hi-lo > SMALL and budget > 0:
+        budget -= 1
+        m = hi-lo
+        step = max(m // int(m ** (2/3)), 1)
+        sample = sorted([key[perm[j]] for j in range(lo, hi, step)])
+        s = len(sample)
+        pos = (k-lo) * s // m
+        gap = int(sqrt(s)) + 1
+        vlo = sample[max(pos-gap, 0)]
+        vhi = sample[min(pos+gap, s-1)]
+        segment = perm[lo:hi]
+        less = [i for i in segment if key[i] < vlo]
+        greater = [i for i in segment if key[i] > vhi]
+        a = lo+len(less)
+        b = hi-len(greater)
+        perm[lo:a] = less
+        perm[a:b] = [i for i in segment if vlo <= key[i] <= vhi]
+        perm[b:hi] = greater
+        if k < a:
+            hi = a
+        elif k >= b:
+            lo = b
+        elif vlo == vhi:
+            return    # all values in the band are the same
+        else:
+            lo, hi = a, b
+    if hi-lo > 1:
+        perm[lo:hi] = sorted(perm[lo:hi], key=key.__getitem__)
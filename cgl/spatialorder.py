@@ -0,0 +1,146 @@
+"""
+Spatial ordering of points and features
+
+Points that are close in space should also be close in memory and be
+processed one after the other, so that tree builds and batches of
+queries keep touching the same nodes. A space-filling curve gives such
+an order: the plane is cut into a grid of 2^bits by 2^bits cells, each
+cell gets its position along the curve as a key, and items are sorted
+by the key of the cell they fall in.
+
+Two curves are supported. The Morton (Z-order) key interleaves the bits
+of the column and row numbers and is cheap to compute. The Hilbert key
+never jumps between cells that are far apart, so it keeps better
+locality at a somewhat higher cost.
+
+Contact:
+Ningchuan Xiao
+The Ohio State University
+Columbus, OH
+"""
+
+__author__ = "Ningchuan Xiao <ncxiao@gmail.com>"
+
+__all__ = ['morton_key', 'hilbert_key', 'point_keys', 'envelope',
+           'feature_keys', 'spatial_order']
+
+from .point import coordinates
+
+BITS = 16   # default number of bits of the grid in each direction
+
+def morton_key(ix, iy, bits=BITS):
+    """
+    Returns the Morton (Z-order) key of grid cell (ix, iy)
+
+    Input
+      ix, iy: column and row of the cell, 0 <= ix, iy < 2**bits
+
+    Output
+      An integer whose even bits are those of ix and odd bits those of iy
+    """
+    key = 0
+    for b in range(bits):
+        key |= ((ix >> b) & 1) << (2*b)
+        key |= ((iy >> b) & 1) << (2*b+1)
+    return key
+
+def hilbert_key(ix, iy, bits=BITS):
+    """
+    Returns the distance of grid cell (ix, iy) along the Hilbert curve
+    that fills a grid of 2**bits by 2**bits cells
+    """
+    n = 1 << bits
+    key = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if ix & s else 0
+        ry = 1 if iy & s else 0
+        key += s * s * ((3*rx) ^ ry)
+        # rotate the quadrant so that the curve inside it has the
+        # same orientation as the whole curve
+        if ry == 0:
+            if rx == 1:
+                ix = n-1 - ix
+                iy = n-1 - iy
+            ix, iy = iy, ix
+        s >>= 1
+    return key
+
+CURVES = {'morton': morton_key, 'hilbert': hilbert_key}
+
+def grid_keys(xs, ys, curve='hilbert', bits=BITS, bounds=None):
+    """
+    Returns the keys of locations xs, ys on a grid that covers bounds,
+    given as (xmin, ymin, xmax, ymax), or the extent of the locations
+    """
+    if curve not in CURVES:
+        raise Exception('Unknown curve: ' + str(curve))
+    key = CURVES[curve]
+    if len(xs) == 0:
+        return []
+    if bounds is None:
+        bounds = (min(xs), min(ys), max(xs), max(ys))
+    xmin, ymin, xmax, ymax = bounds
+    top = (1 << bits) - 1
+    sx = top / (xmax-xmin) if xmax > xmin else 0.0
+    sy = top / (ymax-ymin) if ymax > ymin else 0.0
+    keys = []
+    for x, y in zip(xs, ys):
+        ix = min(max(int((x-xmin)*sx), 0), top)
+        iy = min(max(int((y-ymin)*sy), 0), top)
+        keys.append(key(ix, iy, bits))
+    return keys
+
+def point_keys(points, curve='hilbert', bits=BITS, bounds=None):
+    """
+    Returns the curve keys of points
+
+    Input
+      points: a PointArray, or a sequence of Point objects or (x, y)
+      curve: 'hilbert' or 'morton'
+      bits: number of bits of the grid in each direction
+      bounds: (xmin, ymin, xmax, ymax) covered by the grid, or None to use
+              the extent of the points
+
+    Output
+      A list with the key of each point
+    """
+    xs, ys = coordinates(points)
+    return grid_keys(xs, ys, curve, bits, bounds)
+
+def envelope(feature):
+    """
+    Returns the bounding box (xmin, ymin, xmax, ymax) of a feature as read
+    by cgl.util.shapex, or of any nesting of lists of (x, y) coordinates
+    """
+    coords = feature['geometry']['coordinates'] if isinstance(feature, dict) else feature
+    xmin = ymin = float('inf')
+    xmax = ymax = -float('inf')
+    stack = [coords]
+    while stack:
+        c = stack.pop()
+        if len(c) and isinstance(c[0], (int, float)):
+            x, y = c[0], c[1]
+            xmin, xmax = min(xmin, x), max(xmax, x)
+            ymin, ymax = min(ymin, y), max(ymax, y)
+        else:
+            stack.extend(c)
+    return xmin, ymin, xmax, ymax
+
+def feature_keys(features, curve='hilbert', bits=BITS, bounds=None):
+    """
+    Returns the curve keys of the centers of the envelopes of features.
+    See point_keys for the other arguments.
+    """
+    envelopes = [envelope(f) for f in features]
+    xs = [(e[0]+e[2])/2 for e in envelopes]
+    ys = [(e[1]+e[3])/2 for e in envelopes]
+    return grid_keys(xs, ys, curve, bits, bounds)
+
+def spatial_order(points, curve='hilbert', bits=BITS, bounds=None):
+    """
+    Returns the positions of points sorted along the curve. See
+    point_keys for the arguments.
+    """
+    keys = point_keys(points, curve, bits, bounds)
+    return sorted(range(len(keys)), key=keys.__getitem__)
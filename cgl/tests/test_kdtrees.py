@@ -1,7 +1,11 @@
+import os
 import sys
+import tempfile
+from struct import pack
+from array import array
 sys.path.append('../..')
 from cgl.kdtree import *
-from cgl.point import Point
+from cgl.point import Point, PointArray, METRICS, distance_matrix, cdist_chunked
 
 data1 = [ (2,2), (0,5), (8,0), (9,8), (7,14), (13,12), (14,13) ]
 points = [Point(d[0], d[1]) for d in data1]
@@ -30,4 +34,116 @@ print('Circular:', found)
 print(t1.nearest_neighbor_query(Point(100, 100), 3))
 print(t1.nearest_neighbor_query(p, 3))
 print(t1.nearest_neighbor_query(Point(50, 50), 3))
+print('No neighbors:', t1.nearest_neighbor_query(p, 0), kdtree(points, 'unbalanced').nearest_neighbor_query(p, 0))
 t1.draw()
+
+t3 = kdtree(points, 'flat')
+print([t3.query_kdtree(p)[0] for p in points])
+print('Depth of t3:', t3.depth())
+print('Orthogonal (flat):', t3.range_query_orthogonal(rect))
+print('Circular (flat):', t3.range_query_circular(p, 5))
+print('Annulus:', t3.range_query_circular(p, 5, 4), t2.range_query_circular(p, 5, 4))
+print(t3.nearest_neighbor_query(Point(100, 100), 3))
+print(t3.nearest_neighbor_query(p, 3))
+print('Approximate:', t3.nearest_neighbor_query(p, 3, eps=0.5), t1.nearest_neighbor_query(p, 3, max_visits=2))
+t3.draw()
+print('Pairs within 7:', [list(a) for a in t3.pairs_within(7)])
+try:
+    t3.pairs_within(-1)
+except Exception as e:
+    print('Pairs within -1:', e)
+print('Join:', [list(a) for a in t3.join_knn(kdtree([Point(1, 1), Point(10, 10)], 'flat'), 1)])
+print('Count:', t3.count_range(rect), t1.count_range(rect), 'Sum of x:', t3.sum_range(rect, 'x'))
+tw = kdtree(points, 'flat', weights=[1, 2, 3, 4, 5, 6, 7])
+print('Sum of weights:', tw.sum_range(rect), kdtree.from_arrays([d[0] for d in data1], [d[1] for d in data1], weights=[1, 2, 3, 4, 5, 6, 7]).sum_range(rect))
+t8 = kdtree(points, 'flat', leaf_size=3)
+print('Depth of t8:', t8.depth(), t8.nearest_neighbor_query(p, 3))
+t8.draw()
+# longitude and latitude of a few cities, distances in kilometers
+cities = [Point(-83.0, 40.0, 'Columbus'), Point(-87.6, 41.9, 'Chicago'),
+          Point(-74.0, 40.7, 'New York'), Point(-0.1, 51.5, 'London'),
+          Point(139.7, 35.7, 'Tokyo'), Point(-122.4, 37.8, 'San Francisco')]
+t9 = kdtree(cities, 'flat', metric='haversine')
+print('Haversine:', [(q.key, round(d)) for q, d in t9.nearest_neighbor_query(Point(-80.0, 40.4), 3)])
+print('Within 1000 km:', [q.key for q in kdtree(cities, metric='haversine').range_query_circular(Point(-80.0, 40.4), 1000)])
+t10 = kdtree.from_arrays([d[0] for d in data1], [d[1] for d in data1], ids='abcdefg')
+print('From arrays:', [(q, q.key) for q, d in t10.nearest_neighbor_query(p, 3)])
+# a buffer of doubles, as a NumPy float64 array would give
+t11 = kdtree.from_arrays(memoryview(array('d', [0.5, 10.5, 20.5])), memoryview(array('d', [0.5, 10.5, 20.5])))
+print('From buffers:', t11.size, t11.nearest_neighbor_query(Point(10, 11), 1))
+pa = PointArray.from_points(points)
+print('PointArray:', pa[:3], list(pa.distance(p))[:3], pa.argsort())
+print(kdtree(pa, 'flat').nearest_neighbor_query(p, 3), kdtree(pa).nearest_neighbor_query(p, 3))
+for metric, ps in (('euclidean', points), ('haversine', cities)):
+    m = distance_matrix(ps, pa, metric)
+    d = METRICS[metric][0]
+    print('Distance matrix (' + metric + '):',
+          all(abs(m[i][j] - d(a.x, a.y, b.x, b.y)) < 1e-9 for i, a in enumerate(ps) for j, b in enumerate(pa)),
+          [row for start, rows in cdist_chunked(ps, pa, metric, max_items=10) for row in rows] == m)
+print('Distance matrix (symmetric):', distance_matrix(pa) == distance_matrix(pa, pa))
+print('First two (streamed):', list(t3.iter_range_orthogonal(rect, limit=2)), list(t2.iter_range_circular(p, 5, 2)))
+
+dist, ind = t3.query_batch([(5, 5), (100, 100), (50, 50)], 3)
+print('Batch:', dist, ind)
+print('Batch (Hilbert order):', t3.query_batch([(5, 5), (100, 100), (50, 50)], 3, order='hilbert') == (dist, ind))
+print('Batch (balanced, unbalanced):', t1.query_batch([(5, 5), (100, 100), (50, 50)], 3) == (dist, ind),
+      kdtree(points, 'unbalanced').query_batch([(5, 5), (100, 100), (50, 50)], 3)[0] == dist)
+
+# sorted input makes a degenerate unbalanced tree, deeper than the recursion limit
+points = [Point(i, i) for i in range(2000)]
+t4 = kdtree(points, 'unbalanced')
+print('Depth of t4:', t4.depth())
+print(t4.nearest_neighbor_query(Point(1500.2, 1500), 2))
+
+# a stream of sorted points keeps the tree shallow when inserted one by one
+t7 = kdtree([Point(0, 0)], 'unbalanced')
+for i in range(1, 2000):
+    t7.insert(Point(i, i))
+for i in range(0, 2000, 2):
+    t7.delete(Point(i, i))
+print('Depth of t7:', t7.depth(), 'Size of t7:', t7.size)
+print(t7.nearest_neighbor_query(Point(1500.2, 1500), 2))
+
+fname = os.path.join(tempfile.gettempdir(), 'test_kdtrees.kdt')
+t3.save(fname)
+t6 = kdtree.load(fname)
+print('Loaded:', t6.range_query_orthogonal(rect), t6.nearest_neighbor_query(Point(5, 5), 3))
+t6.summarize(weight=[1, 2, 3, 4, 5, 6, 7])
+print('Sum of weights (loaded):', t6.sum_range(rect))
+os.remove(fname)
+
+# a Point shapefile with the points of data1 and a null shape after the first one
+records = [pack('<idd', 1, d[0], d[1]) for d in data1]
+records.insert(1, pack('<i', 0))
+shp, shx, offset = b'', b'', 50
+for i, c in enumerate(records):
+    shx += pack('>2i', offset, len(c)//2)
+    shp += pack('>2i', i+1, len(c)//2) + c
+    offset += 4 + len(c)//2
+base = os.path.join(tempfile.gettempdir(), 'test_kdtrees')
+for ext, body in (('.shp', shp), ('.shx', shx)):
+    with open(base + ext, 'wb') as f:
+        f.write(pack('>7i', 9994, 0, 0, 0, 0, 0, 50+len(body)//2) + pack('<2i8d', 1000, 1, *[0]*8) + body)
+with open(base + '.dbf', 'wb') as f:
+    f.write(pack('<4xLH22x', len(records), 33+32) + pack('<11sc4xBB14x', b'ID', b'N', 5, 0) + b'\r'
+            + b''.join(b' ' + str(i).rjust(5).encode() for i in range(len(records))))
+from cgl.util.shapex import shapex
+layer = shapex(base + '.shp')
+xs, ys, ids = layer.point_coordinates()
+print('Shapefile points:', list(zip(xs, ys)) == data1, list(ids))
+print('From shapex:', [(q, q.key) for q, d in kdtree.from_shapex(layer).nearest_neighbor_query(p, 3)])
+layer.close()
+for ext in ('.shp', '.shx', '.dbf'):
+    os.remove(base + ext)
+
+if __name__ == '__main__':
+    # worker processes may import this file, so only start them when run as a script
+    data1 = [ (2,2), (0,5), (8,0), (9,8), (7,14), (13,12), (14,13) ]
+    points = [Point(d[0], d[1]) for d in data1]
+    t5 = kdtree(points, 'flat', processes=2)
+    print('Depth of t5:', t5.depth(), 'workers after the build:', t5.flat.workers)
+    print('Batch (2 processes):', t5.query_batch([(5, 5), (50, 50)], 2, processes=2))
+    workers = t5.flat.workers
+    print('Range batch (2 processes):', t5.range_query_batch([rect, [[0, 10], [0, 10]]], processes=2))
+    print('Same workers:', t5.flat.workers is workers)
+    t5.close()
@@ -13,3 +13,32 @@ found = q.range_query(p, 2)
 print(found)
 
 print(q.nearest_neighbor_query(p, 3))
+
+q2 = pointquadtree(points, pqtree_type='unbalanced')
+print('Depth (balanced, unbalanced):', q.depth(), q2.depth())
+# only two distinct x values
+q3 = pointquadtree([Point(i % 2, i) for i in range(4096)])
+print('Depth with repeated x:', q3.depth())
+print(q.insert_pqtree(Point(50.5, 50.5)), q.insert_pqtree(Point(50, 50)))
+print(q.nearest_neighbor_query(p, 3))
+
+pr = prquadtree(points, bounds=(0, 0, 128, 128), capacity=4, max_depth=8)
+print('PR quadtree:', len(pr), 'points, depth', pr.depth())
+print(sorted(pr.range_query(p, 2)) == sorted(found))
+print(pr.nearest_neighbor_query(p, 3))
+
+print(q.nearest_neighbor_query(Point(120, -7), 2))
+print(q2.nearest_neighbor_query(Point(120, -7), 2))
+
+print(q.range_query_orthogonal([[48, 50], [49.5, 51]]))
+print(list(q.iter_range_circular(p, 2, limit=4)))
+window = [(50, 46.5), (53.5, 50), (50, 53.5), (46.5, 50)]
+print(sorted(q2.range_query_polygon(window)) == sorted(x for x in points
+      if abs(x.x-50) + abs(x.y-50) < 3.5))
+
+print(q2.delete(Point(50, 50)), q2.delete(Point(50, 50)))
+print(q2.move(Point(50, 51), (50.2, 50.1)))
+print(q2.nearest_neighbor_query(p, 3))
+print('No neighbors:', q.nearest_neighbor_query(p, 0), pr.nearest_neighbor_query(p, 0))
+q2.insert_pqtree(Point(70.5, 70.5, 'truck'))
+print('Moved:', q2.move(Point(70.5, 70.5), (71.5, 70.5)).key, q2.nearest_neighbor_query(Point(71.5, 70.4), 1)[0][0].key)
@@ -6,6 +6,11 @@ It now only supports four types of shapefile:
 
 History
 
+    October 18, 2026
+        Add point_coordinates to read the coordinates of a Point or
+        MultiPoint layer without building features. The .shp file is
+        mapped into memory instead of being read.
+
     October 9, 2017
         Support slicing!
 
@@ -21,7 +26,9 @@ Author
     ncxiao@gmail.com
 '''
 
-from struct import unpack, calcsize
+import mmap
+from struct import unpack, unpack_from, calcsize
+from array import array
 from os.path import isfile
 from datetime import date
 
@@ -279,6 +286,39 @@ class shapex:
                 feature['geometry']['coordinates'] = multipolygon
         return(feature)
 
+    def point_coordinates(self):
+        '''
+        Reads the coordinates of all the points of a Point or MultiPoint
+        layer straight from the .shp file, without building features or
+        reading the attributes.
+
+        Output
+          xs, ys: arrays of x and y coordinates
+          ids: array of the feature index of each point. Null shapes are
+               skipped, and the points of a MultiPoint share the index.
+        '''
+        if self.shape_type not in ('Point', 'MultiPoint'):
+            raise Exception(self.shape_type + ' is not a point shape type')
+        xs, ys, ids = array('d'), array('d'), array('i')
+        with mmap.mmap(self.f_shp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for i, (offset, length) in enumerate(self.index):
+                pos = offset + 8    # skip record header
+                shape_type = unpack_from('<i', data, pos)[0]
+                if shape_type == 0:
+                    continue
+                if shape_type == 1:
+                    x, y = unpack_from('<2d', data, pos+4)
+                    xs.append(x)
+                    ys.append(y)
+                    ids.append(i)
+                    continue
+                num_points = unpack_from('<i', data, pos+36)[0]
+                points = unpack_from('<'+'d'*num_points*2, data, pos+40)
+                xs.extend(points[0::2])
+                ys.extend(points[1::2])
+                ids.extend([i]*num_points)
+        return xs, ys, ids
+
     def __len__(self):
         return self.num_rec
     def __iter__(self):